@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+对比同步/异步数据库模式下，慢查询对其他请求延迟的影响。
+
+若干个客户端不停地请求一个执行慢查询的接口，同时另一批客户端请求
+/api/review/summary，统计后者的延迟分布。同步模式下慢查询会卡住整个 IOLoop，
+异步模式下则不会。
+
+    python3 benchmarks/async_db.py --duration=10 --slow_ms=200
+"""
+
+import argparse
+import asyncio
+import json
+import shutil
+import time
+import urllib.parse
+
+from common import copy_fixture_db, summarize
+
+import main
+from handlers.base import BaseHandler, js
+from sqlalchemy import event, text
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+
+class SlowQuery(BaseHandler):
+    @js
+    def get(self):
+        seconds = float(self.get_argument("ms", "200")) / 1000
+        self.session.execute(text("SELECT bench_sleep(:s)"), {"s": seconds})
+        return {"err": "ok"}
+
+
+def register_sleep(engine):
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.create_function("bench_sleep", 1, time.sleep)
+
+
+async def client(url, deadline, latencies):
+    http = AsyncHTTPClient()
+    while time.time() < deadline:
+        start = time.time()
+        await http.fetch(url, raise_error=False, request_timeout=120)
+        if latencies is not None:
+            latencies.append(time.time() - start)
+
+
+async def run(db_async, args):
+    main.CONF["db_async"] = db_async
+    app = main.make_app()
+    app.add_handlers(r".*", [(r"/bench/slow", SlowQuery)])
+    register_sleep(app._async_engine.sync_engine if db_async else app._engine)
+
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    AsyncHTTPClient.configure(None, max_clients=args.slow + args.fast)
+
+    base = "http://127.0.0.1:%d" % port
+    slow_url = base + "/bench/slow?ms=%d" % args.slow_ms
+    fast_url = base + "/api/review/summary?book_id=3&chapter_name=" + urllib.parse.quote("活 着")
+    deadline = time.time() + args.duration
+    latencies = []
+    start = time.time()
+    tasks = [client(slow_url, deadline, None) for _ in range(args.slow)]
+    tasks += [client(fast_url, deadline, latencies) for _ in range(args.fast)]
+    await asyncio.gather(*tasks)
+    elapsed = time.time() - start
+
+    server.stop()
+    if db_async:
+        await app._async_engine.dispose()
+    app._engine.dispose()
+    return summarize(latencies, elapsed)
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=10, help="seconds for each mode")
+    parser.add_argument("--slow", type=int, default=2, help="clients calling the slow query")
+    parser.add_argument("--fast", type=int, default=16, help="clients calling /api/review/summary")
+    parser.add_argument("--slow_ms", type=int, default=200, help="duration of the slow query")
+    args = parser.parse_args()
+
+    url, tmpdir = copy_fixture_db()
+    main.CONF["user_database"] = url
+    main.CONF["autoreload"] = False
+    try:
+        result = {
+            "sync": asyncio.run(run(False, args)),
+            "async": asyncio.run(run(True, args)),
+        }
+    finally:
+        shutil.rmtree(tmpdir)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+
+benchdir = os.path.dirname(os.path.realpath(__file__))
+projdir = os.path.realpath(benchdir + "/../")
+if projdir not in sys.path:
+    sys.path.append(projdir)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100.0 * len(values))) - 1))
+    return values[k]
+
+
+def summarize(latencies, elapsed):
+    """latencies 单位为秒，输出毫秒"""
+    return {
+        "count": len(latencies),
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0,
+        "p50": round(percentile(latencies, 50) * 1000, 2),
+        "p95": round(percentile(latencies, 95) * 1000, 2),
+        "p99": round(percentile(latencies, 99) * 1000, 2),
+        "max": round(max(latencies) * 1000, 2) if latencies else 0,
+    }
+
+
+def copy_fixture_db():
+    """复制单测数据库到临时目录并执行迁移，返回 (数据库地址, 临时目录)"""
+    import migrations
+    from sqlalchemy import create_engine
+
+    tmpdir = tempfile.mkdtemp(prefix="brs-bench-")
+    path = os.path.join(tmpdir, "bench.db")
+    shutil.copyfile(os.path.join(projdir, "tests", "candle-reader-unittest.db"), path)
+    url = "sqlite:///" + path
+    engine = create_engine(url)
+    migrations.migrate(engine)
+    engine.dispose()
+    return url, tmpdir
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+/api/review/list 响应在各压缩编码、级别下的体积和 CPU 开销。
+
+每一项给出压缩后的字节数、压缩率、平均压缩耗时，以及在 --mbps 带宽下的传输耗时，
+"total_ms" 为压缩耗时 + 传输耗时，用来在移动网络下挑选编码和级别。
+
+    python3 benchmarks/compression.py --pages=20,50,200 --mbps=2
+"""
+
+import argparse
+import json
+import time
+
+from json_encode import make_reviews
+
+import utils
+from handlers import compress
+
+LEVELS = {"gzip": [1, 6, 9], "br": [1, 4, 6, 11], "zstd": [1, 3, 9]}
+
+
+def measure(codec_factory, level, body, repeat):
+    timings, out = [], b""
+    for _ in range(repeat):
+        start = time.perf_counter()
+        codec = codec_factory(level)
+        out = codec.compress(body) + codec.finish()
+        timings.append(time.perf_counter() - start)
+    return out, sum(timings) / len(timings)
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", default="20,50,200", help="reviews per response")
+    parser.add_argument("--mbps", type=float, default=2.0, help="link speed used for the transfer estimate")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    encoder_name, encode = utils.json_encoder("auto")
+    bytes_per_ms = args.mbps * 1000 * 1000 / 8 / 1000
+    result = {"json_encoder": encoder_name, "mbps": args.mbps, "pages": {}}
+    for n in [int(i) for i in args.pages.split(",")]:
+        body = encode(make_reviews(n))
+        rows = {"identity": {"bytes": len(body), "ratio": 1.0, "compress_ms": 0.0,
+                             "transfer_ms": round(len(body) / bytes_per_ms, 2)}}
+        rows["identity"]["total_ms"] = rows["identity"]["transfer_ms"]
+        for name, factory in compress.CODECS.items():
+            for level in LEVELS[name]:
+                out, seconds = measure(factory, level, body, args.repeat)
+                transfer = len(out) / bytes_per_ms
+                rows["%s-%d" % (name, level)] = {
+                    "bytes": len(out),
+                    "ratio": round(len(body) / len(out), 1),
+                    "compress_ms": round(seconds * 1000, 3),
+                    "transfer_ms": round(transfer, 2),
+                    "total_ms": round(seconds * 1000 + transfer, 2),
+                }
+        result["pages"][str(n)] = rows
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+对比 /api/review/list 返回 500 条评论时各 JSON 编码方式的耗时。
+
+基准是 tornado 自带的 RequestHandler.write(dict)：json.dumps 得到 str，再转成 bytes；
+其他几种为 utils.json_encoder 支持的库（未安装的跳过），都包含 "</" 的转义。
+
+    python3 benchmarks/json_encode.py --reviews=500 --repeat=200
+"""
+
+import argparse
+import datetime
+import json
+import random
+import time
+
+from common import percentile
+from dataset import COMMENTS
+
+from tornado import escape
+
+import utils
+from models import Reader, Review
+
+
+def make_reviews(n, seed=1):
+    """构造与 ReviewList 相同结构的返回值，约三分之一是带引用的回复；评论内容、时间、用户随机"""
+    rnd = random.Random(seed)
+    now = datetime.datetime.now()
+    users = [Reader(id=i, nickname="读者%d" % rnd.randrange(10 ** 6), avatar="https://cravatar.cn/avatar/%032x"
+                    % rnd.getrandbits(128)) for i in range(50)]
+    reviews = []
+    for i in range(n):
+        t = now - datetime.timedelta(seconds=rnd.randrange(86400 * 30))
+        content = "，".join(rnd.choices(COMMENTS, k=rnd.randint(1, 4))) + rnd.choice("！？。～")
+        r = Review(id=1000 + i, book_id=3, chapter_id=12, segment_id=5, type=0, level=i + 1, geo="127.0.0.1",
+                   content=content, create_time=t, update_time=t, user_id=users[i % 50].id)
+        r.user = users[i % 50]
+        if i % 3 == 2:
+            r.quote = r.root = reviews[i - 1]
+            r.quote_id = r.root_id = reviews[i - 1].id
+        reviews.append(r)
+    rows = [r.to_full_dict(users[0]) for r in reviews]
+    return {"err": "ok", "msg": "", "data": {"list": rows, "next_cursor": "WzEwMCwxMDk5XQ"}}
+
+
+def tornado_write(obj):
+    return escape.utf8(escape.json_encode(obj))
+
+
+def with_escape(encode):
+    def run(obj):
+        data = encode(obj)
+        if b"</" in data:
+            data = data.replace(b"</", b"<\\/")
+        return data
+
+    return run
+
+
+def measure(fn, obj, repeat):
+    fn(obj)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(obj)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reviews", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    obj = make_reviews(args.reviews)
+    encoders = {"tornado": tornado_write}
+    for name in ("json", "ujson", "orjson"):
+        try:
+            encoders[name] = with_escape(utils.json_encoder(name)[1])
+        except ValueError:
+            pass
+
+    result = {}
+    for name, fn in encoders.items():
+        timings = measure(fn, obj, args.repeat)
+        result[name] = {
+            "bytes": len(fn(obj)),
+            "mean_ms": round(sum(timings) / len(timings) * 1000, 3),
+            "p99_ms": round(percentile(timings, 99) * 1000, 3),
+        }
+    base = result["tornado"]["mean_ms"]
+    for r in result.values():
+        r["speedup"] = round(base / r["mean_ms"], 1) if r["mean_ms"] else 0
+    print(json.dumps({"reviews": args.reviews, "repeat": args.repeat, "encoders": result}, indent=2))
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+压测工具：在本进程内用 main.make_app 启动服务，若干个虚拟用户按负载模型混合请求各个接口，
+输出吞吐量和每个接口的 p50/p95/p99（JSON），便于在不同提交之间对比。
+
+    python3 benchmarks/loadgen.py --profile=mixed --concurrency=32 --duration=30
+    python3 benchmarks/loadgen.py --db=sqlite:////data/review.db --mix=summary=70,list=30
+    python3 benchmarks/loadgen.py --url=http://127.0.0.1:8080   # 压测已经运行的服务
+
+每个虚拟用户先登录一次，之后按权重随机选择接口；书和章节按 1/rank 的长尾分布挑选，
+热门章节的请求更多。--targets=db 时改为从数据库（例如 dataset.py 生成的）中取评论最多的章节，
+按评论数加权。
+"""
+
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import random
+import shutil
+import subprocess
+import time
+import urllib.parse
+from http.cookies import SimpleCookie
+
+from common import copy_fixture_db, projdir, summarize
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+PASSWORD = "loadgen"
+
+# 各接口的权重
+PROFILES = {
+    "mixed": {"summary": 45, "list": 35, "add": 15, "login": 5},
+    "read": {"summary": 55, "list": 45},
+    "write": {"summary": 30, "list": 20, "add": 50},
+    "login": {"login": 80, "summary": 20},
+}
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        name, weight = item.split("=", 1)
+        if name.strip() not in ("summary", "list", "add", "login"):
+            raise ValueError("unknown route: %s" % name)
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def git_commit():
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=projdir, stderr=subprocess.DEVNULL)
+        return out.decode().strip()
+    except Exception:
+        return ""
+
+
+def create_users(db_url, n):
+    """创建压测账号，返回邮箱列表；密码哈希只算一次"""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+
+    from models import Reader
+
+    engine = create_engine(db_url)
+    now = datetime.datetime.now()
+    hashed = Reader.make_password_hash(PASSWORD)
+    emails = ["loadgen-%d@bench.local" % i for i in range(n)]
+    with Session(engine) as session:
+        exists = {e for e, in session.query(Reader.email).filter(Reader.email.in_(emails))}
+        for i, email in enumerate(emails):
+            if email not in exists:
+                user = Reader(email=email, nickname="loadgen-%d" % i, password=hashed, permission="")
+                user.create_time = user.update_time = user.access_time = now
+                session.add(user)
+        session.commit()
+    engine.dispose()
+    return emails
+
+
+class Workload:
+    def __init__(self, args, mix):
+        self.args = args
+        self.routes = list(mix)
+        self.weights = [mix[r] for r in self.routes]
+        self.chapter_ids = {}  # (book_id, 章节名) -> chapter_id
+        if args.targets == "db":
+            self.targets, self.target_weights = self.load_targets(args.db, args.chapters * args.books)
+        else:
+            # 虚构的书和章节，预热时各发一条评论创建出来；按 1/rank 分配热度
+            self.targets, self.target_weights = [], []
+            for b in range(args.books):
+                for n in range(args.chapters):
+                    self.targets.append((args.book_base + b, "第%d章" % (n + 1)))
+                    self.target_weights.append(1.0 / (b + 1) / (n + 1))
+        self.target_cum_weights = list(itertools.accumulate(self.target_weights))
+
+    def load_targets(self, db_url, limit):
+        """取数据库中评论最多的章节，按评论数加权"""
+        from sqlalchemy import create_engine, func, select
+
+        from models import ReviewChapter, SegmentReviewCount
+
+        engine = create_engine(db_url)
+        total = func.sum(SegmentReviewCount.review_count).label("total")
+        q = (
+            select(ReviewChapter.book_id, ReviewChapter.alias, ReviewChapter.id, total)
+            .join(SegmentReviewCount, SegmentReviewCount.chapter_id == ReviewChapter.id)
+            .group_by(ReviewChapter.book_id, ReviewChapter.alias, ReviewChapter.id)
+            .order_by(total.desc())
+            .limit(limit)
+        )
+        with engine.connect() as conn:
+            rows = conn.execute(q).all()
+        engine.dispose()
+        if not rows:
+            raise SystemExit("no reviewed chapters in %s" % db_url)
+        for book_id, alias, chapter_id, _ in rows:
+            self.chapter_ids[(book_id, alias)] = chapter_id
+        return [(r[0], r[1]) for r in rows], [r[3] for r in rows]
+
+    def pick(self, rnd):
+        book_id, chapter_name = rnd.choices(self.targets, cum_weights=self.target_cum_weights)[0]
+        segment_id = rnd.randint(1, self.args.segments)
+        return book_id, chapter_name, segment_id
+
+
+class Client:
+    def __init__(self, base, email, workload, stats, rnd):
+        self.base = base
+        self.email = email
+        self.workload = workload
+        self.stats = stats
+        self.rnd = rnd
+        self.cookies = {}
+        self.http = AsyncHTTPClient()
+
+    async def request(self, route, path, method="GET", body=None, record=True):
+        headers = {}
+        if self.cookies:
+            headers["Cookie"] = "; ".join("%s=%s" % kv for kv in self.cookies.items())
+        start = time.perf_counter()
+        rsp = await self.http.fetch(
+            self.base + path, method=method, body=body, headers=headers, raise_error=False, request_timeout=120
+        )
+        elapsed = time.perf_counter() - start
+        for header in rsp.headers.get_list("Set-Cookie"):
+            for key, morsel in SimpleCookie(header).items():
+                self.cookies[key] = morsel.value
+
+        data = None
+        if rsp.code == 200:
+            try:
+                data = json.loads(rsp.body)
+            except ValueError:
+                pass
+        ok = data is not None and data.get("err") == "ok"
+        if record:
+            s = self.stats.setdefault(route, {"latencies": [], "errors": 0})
+            s["latencies"].append(elapsed)
+            if not ok:
+                s["errors"] += 1
+        return data if ok else None
+
+    async def login(self, record=True):
+        body = urllib.parse.urlencode({"email": self.email, "password": PASSWORD})
+        return await self.request("login", "/api/user/sign_in", "POST", body, record)
+
+    async def summary(self):
+        book_id, chapter_name, _ = self.workload.pick(self.rnd)
+        query = urllib.parse.urlencode({"book_id": book_id, "chapter_name": chapter_name})
+        await self.request("summary", "/api/review/summary?" + query)
+
+    async def list(self):
+        book_id, chapter_name, segment_id = self.workload.pick(self.rnd)
+        chapter_id = self.workload.chapter_ids.get((book_id, chapter_name))
+        if chapter_id is None:
+            return await self.add()
+        query = urllib.parse.urlencode({"book_id": book_id, "chapter_id": chapter_id, "segment_id": segment_id})
+        await self.request("list", "/api/review/list?" + query)
+
+    async def add(self, target=None):
+        book_id, chapter_name, segment_id = target or self.workload.pick(self.rnd)
+        body = {
+            "book_id": book_id,
+            "chapter_name": chapter_name,
+            "segment_id": segment_id,
+            "content": "压测评论 %d" % self.rnd.randint(0, 1 << 30),
+        }
+        data = await self.request("add", "/api/review/add", "POST", json.dumps(body), record=target is None)
+        if data:
+            self.workload.chapter_ids[(book_id, chapter_name)] = data["data"]["chapterId"]
+
+    async def run(self, deadline):
+        while time.time() < deadline:
+            route = self.rnd.choices(self.workload.routes, self.workload.weights)[0]
+            await getattr(self, route)()
+
+
+async def run(args, mix):
+    app = server = None
+    base = args.url.rstrip("/")
+    if not base:
+        import main
+
+        main.CONF["user_database"] = args.db
+        main.CONF["autoreload"] = False
+        main.CONF["db_async"] = args.db_async
+        app = main.make_app()
+        sock, port = bind_unused_port()
+        server = HTTPServer(app, xheaders=True)
+        server.add_sockets([sock])
+        base = "http://127.0.0.1:%d" % port
+
+    AsyncHTTPClient.configure(None, max_clients=args.concurrency)
+    workload = Workload(args, mix)
+    stats = {}
+    emails = create_users(args.db, args.concurrency) if not args.url else args.users.split(",")
+    rnd = random.Random(args.seed)
+    clients = [
+        Client(base, emails[i % len(emails)], workload, stats, random.Random(rnd.random()))
+        for i in range(args.concurrency)
+    ]
+
+    # 预热：登录，并让每个目标章节都至少有一条评论
+    await asyncio.gather(*[c.login(record=False) for c in clients])
+    targets = [(b, name, 1) for b, name in workload.targets if (b, name) not in workload.chapter_ids]
+    for i in range(0, len(targets), len(clients)):
+        await asyncio.gather(*[c.add(t) for c, t in zip(clients, targets[i:i + len(clients)])])
+
+    start = time.time()
+    await asyncio.gather(*[c.run(start + args.duration) for c in clients])
+    elapsed = time.time() - start
+
+    if server is not None:
+        server.stop()
+        if app._async_engine is not None:
+            await app._async_engine.dispose()
+        app._engine.dispose()
+
+    routes = {}
+    all_latencies = []
+    for route, s in sorted(stats.items()):
+        routes[route] = summarize(s["latencies"], elapsed)
+        routes[route]["errors"] = s["errors"]
+        all_latencies += s["latencies"]
+    total = summarize(all_latencies, elapsed)
+    total["errors"] = sum(s["errors"] for s in stats.values())
+    return {"total": total, "routes": routes}
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profile", default="mixed", choices=sorted(PROFILES), help="workload profile")
+    parser.add_argument("--mix", default="", help="override weights, e.g. summary=60,list=30,add=10")
+    parser.add_argument("--concurrency", type=int, default=16, help="virtual users")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--db", default="", help="database url, defaults to a copy of the unittest db")
+    parser.add_argument("--db_async", action="store_true", help="run the server with db_async")
+    parser.add_argument("--url", default="", help="load an already running server instead of starting one")
+    parser.add_argument("--users", default="", help="with --url: comma separated emails, password 'loadgen'")
+    parser.add_argument("--targets", default="synthetic", choices=["synthetic", "db"],
+                        help="synthetic books, or the most reviewed chapters of --db (e.g. from dataset.py)")
+    parser.add_argument("--books", type=int, default=20)
+    parser.add_argument("--chapters", type=int, default=30, help="chapters per book; with --targets=db, "
+                        "books * chapters hottest chapters are used")
+    parser.add_argument("--segments", type=int, default=50, help="segments per chapter")
+    parser.add_argument("--book_base", type=int, default=900000, help="first book id used by the benchmark")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="", help="also write the JSON result to this file")
+    args = parser.parse_args()
+    if args.url and not args.users:
+        parser.error("--url requires --users")
+    if args.targets == "db" and not args.db:
+        parser.error("--targets=db requires --db")
+
+    mix = parse_mix(args.mix) if args.mix else PROFILES[args.profile]
+    tmpdir = None
+    if not args.db and not args.url:
+        args.db, tmpdir = copy_fixture_db()
+    elif args.db:
+        import migrations
+        from sqlalchemy import create_engine
+
+        engine = create_engine(args.db)
+        migrations.migrate(engine)
+        engine.dispose()
+
+    try:
+        result = asyncio.run(run(args, mix))
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+
+    result["config"] = {
+        "commit": git_commit(),
+        "profile": args.profile,
+        "mix": mix,
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "db_async": args.db_async,
+        "targets": args.targets,
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    out = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out + "\n")
+    print(out)
+
+
+if __name__ == "__main__":
+    main_()
@@ -6,9 +6,11 @@ def routes():
     from . import user
     from . import review
     from . import stat
+    from . import feed
 
     routes = []
     routes += user.routes()
     routes += review.routes()
     routes += stat.routes()
+    routes += feed.routes()
     return routes
@@ -4,20 +4,76 @@
 
 import base64
 import datetime
+import hashlib
+import inspect
 import logging
+import re
 import time
 import urllib.parse
 from gettext import gettext as _
 
+from sqlalchemy import event, inspect as sa_inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
 from tornado import web
+from tornado.ioloop import IOLoop
 
 import loader
+from handlers.compress import CompressContentEncoding, encoding_etag, negotiated_encoding
 
 # import social_tornado.handlers
 from models import Reader
+from services.metrics import Metrics
+from services.password import PasswordService
+from services import sqlstats
+from utils import LRUCache, json_encoder
 
 CONF = loader.get_settings()
 
+JSON_ENCODER, encode_json = json_encoder(CONF.get("json_encoder", "auto"))
+
+# user_id -> Reader 的字段值；用于 current_user，省掉每个请求一次的用户查询
+READER_CACHE = LRUCache(int(CONF.get("reader_cache_size", 10000)), ttl=int(CONF.get("reader_cache_ttl", 60)))
+
+
+@event.listens_for(Reader, "after_update")
+@event.listens_for(Reader, "after_delete")
+def on_reader_changed(mapper, connection, target):
+    # 资料、密码、权限等变化后让缓存失效；仅更新访问时间（每次登录都会更新）的不算
+    state = sa_inspect(target)
+    changed = [a.key for a in state.attrs if a.key != "access_time" and a.history.has_changes()]
+    if changed or state.deleted:
+        READER_CACHE.pop(target.id)
+        Session.object_session(target).info.setdefault("changed_readers", set()).add(target.id)
+
+
+@event.listens_for(Session, "after_commit")
+def on_session_commit(session):
+    # 提交之后再清一次，避免提交前有其他请求把旧数据又放回缓存
+    for user_id in session.info.pop("changed_readers", ()):
+        READER_CACHE.pop(user_id)
+
+
+def origin_allowed(origin, allowed_origins):
+    """
+    origin 是否在允许列表中，支持 "*" 和 "*.talebook.org" 形式的通配符。
+    通配符按 origin 中的主机名匹配 talebook.org 本身及其子域名，eviltalebook.org 不算。
+    """
+    try:
+        host = urllib.parse.urlsplit(origin).hostname or ""
+    except ValueError:
+        host = ""
+    for allowed_origin in allowed_origins:
+        if allowed_origin == '*':
+            return True
+        elif allowed_origin.startswith('*.'):
+            # 处理通配符情况，如*.talebook.org
+            domain = allowed_origin[2:].lower()  # 去掉*.前缀
+            if host == domain or host.endswith("." + domain):
+                return True
+        elif origin == allowed_origin:
+            return True
+    return False
+
 
 def day_format(value, format="%Y-%m-%d"):
     try:
@@ -27,22 +83,41 @@ def day_format(value, format="%Y-%m-%d"):
 
 
 def js(func):
-    def do(self, *args, **kwargs):
+    is_coroutine = inspect.iscoroutinefunction(func)
+
+    def on_error(e):
+        import traceback
+
+        logging.error(traceback.format_exc())
+        msg = 'Exception:<br><pre style="white-space:pre-wrap;word-break:keep-all">%s</pre>' % traceback.format_exc()
+        rsp = {"err": "exception", "msg": msg}
+        if isinstance(e, web.Finish):
+            rsp = ""
+        return rsp
+
+    def run(self, *args, **kwargs):
         try:
             rsp = func(self, *args, **kwargs)
             rsp["msg"] = rsp.get("msg", "")
         except Exception as e:
-            import traceback
-
-            logging.error(traceback.format_exc())
-            msg = (
-                'Exception:<br><pre style="white-space:pre-wrap;word-break:keep-all">%s</pre>' % traceback.format_exc()
-            )
-            rsp = {"err": "exception", "msg": msg}
-            if isinstance(e, web.Finish):
-                rsp = ""
+            rsp = on_error(e)
+        return rsp
+
+    async def run_coroutine(self, *args, **kwargs):
+        try:
+            rsp = await func(self, *args, **kwargs)
+            rsp["msg"] = rsp.get("msg", "")
+        except Exception as e:
+            rsp = on_error(e)
+        return rsp
+
+    def respond(self, rsp):
         self.prepare_headers()
         self.set_header("Cache-Control", "max-age=0")
+        if getattr(self, "not_modified", False):
+            # 处理函数已经通过 check_etag 确认客户端的缓存仍然有效
+            self.finish()
+            return
         # 根据err字段设置HTTP状态码
         if isinstance(rsp, dict):
             if rsp.get("err") != "ok":
@@ -53,6 +128,20 @@ def js(func):
                 self.set_status(200)
         self.write(rsp)
         self.finish()
+
+    async def do_async(self, *args, **kwargs):
+        if is_coroutine:
+            # 协程形式的处理函数，自己通过 run_db 访问数据库
+            rsp = await run_coroutine(self, *args, **kwargs)
+        else:
+            # 异步模式下，整个处理函数在 greenlet 中执行，其中的 ORM 调用等待数据库时会让出 IOLoop
+            rsp = await self.async_session.run_sync(lambda session: run(self, *args, **kwargs))
+        respond(self, rsp)
+
+    def do(self, *args, **kwargs):
+        if is_coroutine or getattr(self, "async_session", None) is not None:
+            return do_async(self, *args, **kwargs)
+        respond(self, run(self, *args, **kwargs))
         return
 
     return do
@@ -64,7 +153,12 @@ def auth(func):
             return {"err": "user.need_login", "msg": _(u"请先登录")}
         return func(self, *args, **kwargs)
 
-    return do
+    async def do_async(self, *args, **kwargs):
+        if not self.current_user:
+            return {"err": "user.need_login", "msg": _(u"请先登录")}
+        return await func(self, *args, **kwargs)
+
+    return do_async if inspect.iscoroutinefunction(func) else do
 
 
 class BaseHandler(web.RequestHandler):
@@ -80,14 +174,24 @@ class BaseHandler(web.RequestHandler):
         # 解码URI，显示中文而不是URL编码
         decoded_uri = urllib.parse.unquote(self.request.uri)
 
-        return '%s %s (%s) "%d %s"' % (
+        return '%s %s (%s) "%d %s" %s' % (
             self.request.method,
             decoded_uri,
             self.request.remote_ip,
             userid,
             email,
+            self.sql_stats,
         )
 
+    def write(self, chunk):
+        # dict 用配置的 JSON 库直接编码为 bytes，代替 tornado 内置的 json.dumps
+        if isinstance(chunk, dict):
+            chunk = encode_json(chunk)
+            if b"</" in chunk:
+                chunk = chunk.replace(b"</", b"<\\/")  # 与 tornado 一样，避免在 HTML 中提前闭合 <script>
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
+        super(BaseHandler, self).write(chunk)
+
     def get_secure_cookie(self, key):
         if not self.cookies_cache.get(key, ""):
             self.cookies_cache[key] = super(BaseHandler, self).get_secure_cookie(key)
@@ -111,19 +215,20 @@ class BaseHandler(web.RequestHandler):
     def options(self, *args, **kwargs):
         return self.finish()
 
-    def process_auth_header(self):
+    async def process_auth_header(self):
         auth_header = self.request.headers.get("Authorization", "")
         if not auth_header.startswith("Basic "):
             return False
         try:
             auth_decoded = base64.decodebytes(auth_header[6:].encode("ascii")).decode("UTF-8")
             email, password = auth_decoded.split(":", 2)
-            user = self.session.query(Reader).filter(Reader.email == email).first()
+            user = await self.run_db(lambda: self.session.query(Reader).filter(Reader.email == email).first())
             if not user:
                 return False
-            if not user.get_secure_password(password):
+            await self.release_db()
+            if not await PasswordService().check(user, password):
                 return False
-            self.login_user(user)
+            await self.run_db(self.login_user, user)
             return True
         except Exception as e:
             logging.error(f"Basic auth failed: {e}")
@@ -149,25 +254,8 @@ class BaseHandler(web.RequestHandler):
         origin = self.request.headers.get("origin", "*")
 
         # 处理CORS Origin，支持通配符
-        if allowed_origins != ['*']:
-            # 检查origin是否在允许列表中，支持通配符
-            origin_allowed = False
-            for allowed_origin in allowed_origins:
-                if allowed_origin == '*':
-                    origin_allowed = True
-                    break
-                elif allowed_origin.startswith('*.'):
-                    # 处理通配符情况，如*.talebook.org
-                    domain = allowed_origin[2:]  # 去掉*.前缀
-                    if origin.endswith(domain) or origin == domain:
-                        origin_allowed = True
-                        break
-                elif origin == allowed_origin:
-                    origin_allowed = True
-                    break
-
-            if not origin_allowed:
-                origin = allowed_origins[0] if allowed_origins else '*'
+        if not origin_allowed(origin, allowed_origins):
+            origin = allowed_origins[0] if allowed_origins else '*'
 
         self.set_header("Access-Control-Allow-Origin", origin)
         self.set_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE')
@@ -175,24 +263,63 @@ class BaseHandler(web.RequestHandler):
         self.set_header("Access-Control-Allow-Credentials", "true")
 
     def prepare(self):
+        self.start_time = time.perf_counter()
+        self.sql_stats = sqlstats.start_request()
         self.prepare_headers()
         self.set_hosts()
         self.set_i18n()
-        self.process_auth_header()
+        if self.async_session is not None or "Authorization" in self.request.headers:
+            return self.prepare_async()
+
+    async def prepare_async(self):
+        await self.process_auth_header()
+        # _request_summary 等同步代码也会用到 current_user，先在这里查出来
+        await self.run_db(lambda: self.current_user)
+
+    async def run_db(self, fn, *args, **kwargs):
+        """执行会访问数据库的同步函数；异步模式下在 greenlet 中执行，不阻塞 IOLoop"""
+        if self.async_session is None:
+            return fn(*args, **kwargs)
+        return await self.async_session.run_sync(lambda session: fn(*args, **kwargs))
+
+    async def release_db(self):
+        """
+        在等待耗时的非数据库操作（如校验密码）之前归还数据库连接。
+        已查出的对象会脱离 session 但保留属性值，之后 session.add() 即可继续修改。
+        """
+        if self.async_session is None:
+            self.session.close()
+        else:
+            await self.async_session.close()
 
     def set_i18n(self):
         return
 
     def initialize(self):
-        ScopedSession = self.settings["ScopedSession"]
-        self.session = ScopedSession()  # new sql session
+        AsyncSession = self.settings.get("AsyncSession")
+        if AsyncSession:
+            # 异步模式：每个请求一个 AsyncSession，self.session 是它对应的同步接口
+            self.async_session = AsyncSession()
+            self.session = self.async_session.sync_session
+        else:
+            # 每个请求独占一个 session：协程形式的处理函数在 await 时会与同线程的其他请求交错执行，
+            # 不能共用线程级的 ScopedSession()，否则别的请求结束时会把本请求的 session 关掉
+            ScopedSession = self.settings["ScopedSession"]
+            self.async_session = None
+            self.session = ScopedSession.session_factory()
         self.admin_user = None
         self.cookies_cache = {}
+        self.sql_stats = sqlstats.QueryStats()
 
     def on_finish(self):
-        ScopedSession = self.settings["ScopedSession"]
+        start = getattr(self, "start_time", None)
+        elapsed = time.perf_counter() - start if start else self.request.request_time()
+        Metrics().observe_request(type(self).__name__, self.request.method, self.get_status(), elapsed)
+
+        if self.async_session is not None:
+            IOLoop.current().add_callback(self.async_session.close)
+            return
         self.session.close()
-        ScopedSession.remove()
 
     def static_url(self, path, **kwargs):
         if path.endswith("/"):
@@ -209,10 +336,30 @@ class BaseHandler(web.RequestHandler):
         return int(uid) if uid and uid.isdigit() else None
 
     def get_current_user(self):
+        """
+        返回当前用户。命中缓存时是一个只读的快照（不在当前 session 中），
+        需要修改用户信息的接口请使用 live_user()。
+        """
         user_id = self.user_id()
-        if user_id:
-            user_id = int(user_id)
-        return self.session.get(Reader, user_id) if user_id else None
+        if not user_id:
+            return None
+        user_id = int(user_id)
+        values = READER_CACHE.get(user_id)
+        if values is None:
+            user = self.session.get(Reader, user_id)
+            if user is not None:
+                READER_CACHE.set(user_id, user.to_dict())
+            return user
+
+        user = Reader(**values)
+        make_transient_to_detached(user)
+        return user
+
+    def live_user(self):
+        """当前用户在本次 session 中的 ORM 对象，可以修改并提交"""
+        if not self.current_user:
+            return None
+        return self.session.get(Reader, self.current_user.id)
 
     def is_admin(self):
         if self.admin_user:
@@ -229,6 +376,38 @@ class BaseHandler(web.RequestHandler):
         self.session.add(user)
         self.session.commit()
 
+    def check_etag(self, *version):
+        """
+        用数据的版本号生成强 ETag 并写入响应头；与请求的 If-None-Match 相同时把状态码设为 304，
+        返回 True，处理函数随即返回，不必再查询和序列化数据。
+        version 需要包含影响返回内容的所有参数（分页、当前用户等）。
+        """
+        raw = repr((JSON_ENCODER,) + version).encode("UTF-8")
+        etag = '"%s"' % hashlib.sha1(raw).hexdigest()
+        # 压缩后的响应带编码后缀（handlers.compress.encoding_etag），客户端缓存的可能是未压缩或本次协商的编码的表示；
+        # 304 的 ETag 为匹配上的那一个，与客户端缓存的一致
+        etags = [etag]
+        if CompressContentEncoding in self.application.transforms:
+            encoding = negotiated_encoding(self.request)
+            if encoding:
+                etags.append(encoding_etag(etag, encoding))
+        matched = self.match_etag(etags)
+        self.set_header("Etag", matched or etag)
+        self.not_modified = matched is not None
+        if self.not_modified:
+            self.set_status(304)
+        return self.not_modified
+
+    def match_etag(self, etags):
+        """If-None-Match 中与 etags 之一相同（弱比较）的那个，没有时返回 None"""
+        for tag in re.findall(r'\*|(?:W/)?"[^"]*"', self.request.headers.get("If-None-Match", "")):
+            if tag == "*":
+                return etags[0]
+            tag = tag[2:] if tag.startswith("W/") else tag
+            if tag in etags:
+                return tag
+        return None
+
     def last_modified(self, updated):
         """
         Generates a locale independent, english timestamp from a datetime
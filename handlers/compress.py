@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+响应压缩：按请求的 Accept-Encoding 协商 zstd / br / gzip。
+
+brotli、zstandard 未安装时对应的编码不可用；配置项见 settings.py 中的 compress_*。
+不使用 tornado 自带的 compress_response，它只支持 gzip。
+"""
+
+import zlib
+
+from tornado import httputil
+from tornado.web import OutputTransform
+
+import loader
+
+CONF = loader.get_settings()
+
+# tornado 的 GZipContentEncoding 之外，text/* 也都压缩
+CONTENT_TYPES = {
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+}
+
+# SSE 每个事件都要立即送达，压缩后只能逐条 flush，收益很小，还可能被中间的代理缓冲
+SKIP_CONTENT_TYPES = {"text/event-stream"}
+
+# gzip 1-9，br 0-11，zstd 1-22；以下为各自常用的折中值
+DEFAULT_LEVELS = {"gzip": 6, "br": 4, "zstd": 3}
+
+
+class Codec:
+    """流式压缩：compress 追加数据，flush 输出目前为止的数据（用于分块发送），finish 结束"""
+
+    def __init__(self, compress, flush, finish):
+        self.compress = compress
+        self.flush = flush
+        self.finish = finish
+
+
+def gzip_codec(level):
+    c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return Codec(c.compress, lambda: c.flush(zlib.Z_SYNC_FLUSH), c.flush)
+
+
+def brotli_codec(level):
+    import brotli
+
+    c = brotli.Compressor(quality=level)
+    return Codec(c.process, c.flush, c.finish)
+
+
+def zstd_codec(level):
+    import zstandard
+
+    c = zstandard.ZstdCompressor(level=level).compressobj()
+    return Codec(c.compress, lambda: c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK), c.flush)
+
+
+def available_codecs():
+    codecs = {"gzip": gzip_codec}
+    try:
+        import brotli  # noqa: F401
+
+        codecs["br"] = brotli_codec
+    except ImportError:
+        pass
+    try:
+        import zstandard  # noqa: F401
+
+        codecs["zstd"] = zstd_codec
+    except ImportError:
+        pass
+    return codecs
+
+
+CODECS = available_codecs()
+
+
+def parse_accept_encoding(value):
+    """返回 {编码: q 值}，例如 "gzip, br;q=0.8" -> {"gzip": 1.0, "br": 0.8}"""
+    accepted = {}
+    for item in value.split(","):
+        parts = [p.strip() for p in item.split(";")]
+        if not parts[0]:
+            continue
+        q = 1.0
+        for p in parts[1:]:
+            if p.startswith("q="):
+                try:
+                    q = float(p[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[parts[0].lower()] = q
+    return accepted
+
+
+def choose_encoding(accept_encoding, preferred):
+    """在客户端接受（q>0）且本机可用的编码中，选 q 值最高的；q 值相同时按 preferred 的顺序"""
+    accepted = parse_accept_encoding(accept_encoding)
+    best, best_q = None, 0.0
+    for name in preferred:
+        if name not in CODECS:
+            continue
+        q = accepted.get(name, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+def negotiated_encoding(request):
+    """本请求的响应会使用的编码（够大、类型可压缩时），客户端不接受任何可用的编码时为 None"""
+    return choose_encoding(request.headers.get("Accept-Encoding", ""), CONF.get("compress_encodings", ["gzip"]))
+
+
+def encoding_etag(etag, encoding):
+    """
+    压缩后的响应是同一资源的另一种表示，字节不同，强 ETag 也要不同：'"<hash>"' -> '"<hash>-gzip"'。
+    压缩时由 CompressContentEncoding 改写，BaseHandler.check_etag 比对 If-None-Match 时按同样的规则生成。
+    """
+    return etag[:-1] + "-" + encoding + '"'
+
+
+class CompressContentEncoding(OutputTransform):
+    def __init__(self, request):
+        self._encoding = negotiated_encoding(request)
+        self._codec = None
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        if "Vary" in headers:
+            headers["Vary"] += ", Accept-Encoding"
+        else:
+            headers["Vary"] = "Accept-Encoding"
+
+        ctype = httputil.native_str(headers.get("Content-Type", "")).split(";")[0].strip()
+        if (
+            self._encoding is None
+            or status_code in (204, 304)
+            or "Content-Encoding" in headers
+            or not (ctype.startswith("text/") or ctype in CONTENT_TYPES)
+            or ctype in SKIP_CONTENT_TYPES
+            or (finishing and len(chunk) < int(CONF.get("compress_min_size", 1024)))
+        ):
+            return status_code, headers, chunk
+
+        level = CONF.get("compress_levels", {}).get(self._encoding, DEFAULT_LEVELS[self._encoding])
+        self._codec = CODECS[self._encoding](level)
+        headers["Content-Encoding"] = self._encoding
+        etag = headers.get("Etag")
+        if etag and not etag.startswith("W/"):
+            headers["Etag"] = encoding_etag(etag, self._encoding)
+
+        chunk = self.transform_chunk(chunk, finishing)
+        if "Content-Length" in headers:
+            if finishing:
+                headers["Content-Length"] = str(len(chunk))
+            else:
+                del headers["Content-Length"]
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        if self._codec is None:
+            return chunk
+        data = self._codec.compress(chunk)
+        return data + (self._codec.finish() if finishing else self._codec.flush())
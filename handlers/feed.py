@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+章节的实时评论流：客户端通过 WebSocket 订阅正在阅读的章节，ReviewAdd 提交后推送新评论。
+
+客户端发送：
+    {"action": "subscribe", "book_id": 1, "chapter_id": 2}   同一连接同时只订阅一个章节，再次订阅即切换
+    {"action": "unsubscribe"}
+服务端推送：
+    {"type": "subscribed", "bookId": 1, "chapterId": 2}
+    {"type": "review", "bookId": 1, "chapterId": 2, "segmentId": 3, "count": 5, "review": {...}}
+        count 为该段落当前的评论数，review 与 /api/review/list 中的一条相同
+    {"type": "resync", "bookId": 1, "chapterId": 2}
+        推送积压过多、中间有消息被丢弃，或者其他进程有新评论，客户端应重新拉取 /api/review/summary
+    {"type": "error", "err": "params.invalid"}
+
+新评论只推给同一进程内的连接。多进程模式下由 FeedPoller 每隔 feed_poll_interval 秒检查本进程
+订阅的章节版本号（review_chapters.review_version），有本进程之外的新评论时发送 resync。
+"""
+
+import logging
+
+import tornado.escape
+from tornado import websocket
+from sqlalchemy import select
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+import loader
+from handlers.base import encode_json, origin_allowed
+from models import ReviewChapter
+from services.pubsub import PubSub
+
+CONF = loader.get_settings()
+
+
+def chapter_channel(book_id, chapter_id):
+    return ("chapter", int(book_id), int(chapter_id))
+
+
+def publish_review(review, data):
+    """
+    把新评论推给订阅了该章节的连接，data 为 review.to_full_dict() 的结果。
+    消息只编码一次，各连接发送同一份 bytes；没有订阅者时什么也不做。
+    """
+    channel = chapter_channel(review.book_id, review.chapter_id)
+    if not PubSub().has_subscribers(channel):
+        return 0
+    message = {
+        "type": "review",
+        "bookId": int(review.book_id),
+        "chapterId": review.chapter_id,
+        "segmentId": review.segment_id,
+        "count": review.level,
+        "review": dict(data, isSelf=False),
+    }
+    return PubSub().publish(channel, encode_json(message))
+
+
+class ReviewFeed(websocket.WebSocketHandler):
+    def check_origin(self, origin):
+        allowed_origins = CONF.get("allowed_origins", ["*"])
+        return origin_allowed(origin, allowed_origins)
+
+    def open(self):
+        self.subscription = None
+
+    def on_message(self, message):
+        try:
+            data = tornado.escape.json_decode(message)
+            action = data["action"]
+        except (ValueError, TypeError, KeyError):
+            return self.send({"type": "error", "err": "params.invalid"})
+
+        if action == "unsubscribe":
+            self.unsubscribe()
+            return
+        if action != "subscribe":
+            return self.send({"type": "error", "err": "params.invalid"})
+        try:
+            channel = chapter_channel(data["book_id"], data["chapter_id"])
+        except (ValueError, TypeError, KeyError):
+            return self.send({"type": "error", "err": "params.invalid"})
+
+        self.unsubscribe()
+        self.subscription = PubSub().subscribe(channel, int(CONF.get("feed_queue_size", 64)))
+        self.send({"type": "subscribed", "bookId": channel[1], "chapterId": channel[2]})
+        IOLoop.current().spawn_callback(self.pump, self.subscription)
+
+    async def pump(self, sub):
+        """
+        把订阅收到的消息逐条发给客户端。等上一条写入 socket 缓冲区后才发下一条，
+        客户端读得慢时消息积压在订阅的有界队列里；队列满了丢弃最旧的，并通知客户端重新同步。
+        """
+        while not sub.closed:
+            messages = await sub.get()
+            try:
+                if sub.dropped:
+                    sub.dropped = 0
+                    await self.write_message(resync_message(sub.key))
+                    continue
+                for message in messages:
+                    await self.write_message(message)
+            except websocket.WebSocketClosedError:
+                break
+        sub.close()
+
+    def send(self, message):
+        try:
+            self.write_message(encode_json(message))
+        except websocket.WebSocketClosedError:
+            logging.debug("feed connection closed")
+
+    def unsubscribe(self):
+        if self.subscription is not None:
+            self.subscription.close()
+            self.subscription = None
+
+    def on_close(self):
+        self.unsubscribe()
+
+
+def resync_message(channel):
+    return encode_json({"type": "resync", "bookId": channel[1], "chapterId": channel[2]})
+
+
+class FeedPoller:
+    """
+    多进程模式下，其他进程提交的评论推不到本进程的连接。定时用一条查询读取本进程有订阅的章节的 review_version，
+    版本号的增量多于本进程提交的评论数时，向该章节的连接发送 resync。
+
+    ReviewAdd 在提交之前调用 expect() 登记本进程的评论，提交失败时撤销；检查落在提交的过程中时，
+    登记数多于增量，等提交完成后的下一次检查再比对，不会误判为其他进程的评论。
+    """
+
+    instance = None  # 多进程模式下由 main 启动
+
+    def __init__(self, ScopedSession, AsyncSession=None):
+        self.ScopedSession = ScopedSession
+        self.AsyncSession = AsyncSession
+        self.versions = {}  # 章节 -> 比对的基准版本号
+        self.local = {}  # 章节 -> 基准版本号之后本进程登记的评论数
+
+    def start(self, interval):
+        FeedPoller.instance = self
+        PeriodicCallback(self.poll, interval * 1000).start()
+
+    @classmethod
+    def expect(cls, book_id, chapter_id, n=1):
+        poller, channel = cls.instance, chapter_channel(book_id, chapter_id)
+        if poller is not None and PubSub().has_subscribers(channel):
+            poller.local[channel] = poller.local.get(channel, 0) + n
+
+    def read_versions(self, session, chapter_ids):
+        q = select(ReviewChapter.book_id, ReviewChapter.id, ReviewChapter.review_version)
+        return session.execute(q.where(ReviewChapter.id.in_(chapter_ids))).all()
+
+    async def fetch_versions(self, chapter_ids):
+        """异步模式走 AsyncSession；同步模式在线程池中查询，都不阻塞 IOLoop"""
+        if self.AsyncSession is not None:
+            async with self.AsyncSession() as session:
+                return await session.run_sync(self.read_versions, chapter_ids)
+
+        def read():
+            session = self.ScopedSession.session_factory()
+            try:
+                return self.read_versions(session, chapter_ids)
+            finally:
+                session.close()
+
+        return await IOLoop.current().run_in_executor(None, read)
+
+    async def poll(self):
+        channels = PubSub().keys("chapter")
+        rows = await self.fetch_versions(sorted({channel[2] for channel in channels})) if channels else []
+        for book_id, chapter_id, version in rows:
+            channel, version = chapter_channel(book_id, chapter_id), version or 0
+            if not PubSub().has_subscribers(channel):
+                continue
+            base = self.versions.get(channel)
+            local = self.local.get(channel, 0)
+            if base is None or version - base >= local:
+                if base is not None and version - base > local:
+                    PubSub().publish(channel, resync_message(channel))
+                self.versions[channel], self.local[channel] = version, 0
+        # 已经没有订阅的章节不再跟踪
+        for channel in set(self.versions) - set(PubSub().keys("chapter")):
+            del self.versions[channel]
+            self.local.pop(channel, None)
+
+
+def routes():
+    return [
+        (r"/api/review/feed", ReviewFeed),
+    ]
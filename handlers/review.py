@@ -5,11 +5,79 @@ import datetime
 from gettext import gettext as _
 
 import tornado.escape
-from handlers.base import BaseHandler, auth, js
-from models import Review, ReviewBook, ReviewChapter
+from tornado.iostream import StreamClosedError
+from handlers.base import BaseHandler, auth, encode_json, js
+from handlers.feed import FeedPoller, publish_review
+from models import Reader, Review, ReviewBook, ReviewBookAlias, ReviewChapter, ReviewInbox, SegmentReviewCount
+
+import loader
+import search
+from sqlalchemy import and_, case, func, literal, or_
+from sqlalchemy.orm import joinedload
+from services.pubsub import PubSub
+from utils import LRUCache, decode_cursor, encode_cursor, super_strip
+
+CONF = loader.get_settings()
+
+# (book_id, chapter_id) -> (章节版本号, {segment_id: review_num})
+# 每次使用前与 segment_review_counts 中的版本号比对，其他进程写入的评论也不会读到过期的数量
+SUMMARY_CACHE = LRUCache(int(CONF.get("summary_cache_size", 10000)))
+
+
+def with_full_dict(q):
+    """to_full_dict 用到的用户、引用评论一次查出来，避免逐行懒加载"""
+    return q.options(joinedload(Review.user), joinedload(Review.quote).joinedload(Review.user))
+
+
+def get_page_args(handler, cursor_size=2):
+    """解析分页参数 limit、cursor，参数不合法时返回 None"""
+    limit = handler.get_argument("limit", "").strip()
+    if limit and not limit.isdigit():
+        return None
+    limit = int(limit) if limit else int(CONF.get("review_page_size", 50))
+    limit = max(1, min(limit, int(CONF.get("review_page_max", 200))))
+
+    cursor = handler.get_argument("cursor", "").strip()
+    if not cursor:
+        return limit, None
+    cursor = decode_cursor(cursor)
+    if cursor is None or len(cursor) != cursor_size:
+        return None
+    return limit, cursor
+
+
+def read_watermark(session, user_id):
+    """从 readers 表读取已读位置；current_user 可能来自缓存的快照，标记已读后还没有更新"""
+    return session.query(Reader.last_read_id).filter(Reader.id == user_id).scalar() or 0
+
+
+def unread_count(session, user_id, last_read_id=None):
+    """「与我相关」的未读数；last_read_id 为 None 时从 readers 表读取"""
+    if last_read_id is None:
+        last_read_id = read_watermark(session, user_id)
+    q = session.query(func.count(ReviewInbox.id))
+    return q.filter(ReviewInbox.recipient_id == user_id, ReviewInbox.id > last_read_id).scalar()
+
+
+def unread_channel(user_id):
+    return ("unread", user_id)
+
+
+def publish_unread(session, user_id, last_read_id=None):
+    """有长连接在等时，把最新的未读数推给该用户"""
+    channel = unread_channel(user_id)
+    if PubSub().has_subscribers(channel):
+        PubSub().publish(channel, {"count": unread_count(session, user_id, last_read_id)})
+
+
+def fetch_page(q, limit, cursor_of):
+    """多取一行用来判断是否还有下一页，返回 (rows, next_cursor)"""
+    rows = q.limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, ""
+    rows = rows[:limit]
+    return rows, encode_cursor(*cursor_of(rows[-1]))
 
-from sqlalchemy import func, or_
-from utils import super_strip
 
 # reader在获取toc后，将toc传递给server，然后构建对应的结构表；
 # book_id -> [chapter_id] -> [segment_id]
@@ -36,18 +104,72 @@ class ReviewSummary(BaseHandler):
         if chapter is None:
             return {"err": "ok", "data": {"list": []}}
 
-        # 查询评论数量
-        q = self.session.query(Review.segment_id, func.count().label("cnt"))
-        q = q.filter(Review.book_id == book_id, Review.chapter_id == chapter.id)
-        q = q.group_by(Review.segment_id)
+        # 返回内容完全由章节 ID 和各段落评论数决定；评论数的版本号和章节一起查出，比对 ETag 和缓存都不需要额外的查询
+        version = chapter.review_version
+        if self.check_etag("summary", chapter.id, version):
+            return {"err": "ok"}
 
-        data = []
-        for row in q.all():
-            segment_id, cnt = row
-            data.append({"segmentId": segment_id, "reviewNum": cnt})
+        key = (int(book_id), chapter.id)
+        cached = SUMMARY_CACHE.get(key)
+        if cached is None or cached[0] != version:
+            # 版本号在评论数之前读出，之后才提交的评论只会让下次比对失败，不会一直缓存旧值
+            cached = (version, SegmentReviewCount.chapter_counts(self.session, int(book_id), chapter.id))
+            SUMMARY_CACHE.set(key, cached)
+        counts = cached[1]
+
+        data = [{"segmentId": segment_id, "reviewNum": cnt} for segment_id, cnt in counts.items()]
         return {"err": "ok", "data": {"chapter_id": chapter.id, "list": data}}
 
 
+class ReviewBookSummary(BaseHandler):
+    """获取「某书」所有章节的评论总数，以及指定章节的各段落评论数（用于目录页的评论角标）"""
+
+    MAX_CHAPTERS = 100
+
+    @js
+    def get(self):
+        book_id = super_strip(self.get_argument("book_id", ""))
+        chapter_ids = super_strip(self.get_argument("chapter_ids", ""))
+        if not book_id or not book_id.isdigit():
+            return {"err": "params.invalid", "msg": _("参数错误")}
+        book_id = int(book_id)
+
+        ids = [i.strip() for i in chapter_ids.split(",") if i.strip()]
+        if not all(i.isdigit() for i in ids) or len(ids) > self.MAX_CHAPTERS:
+            return {"err": "params.invalid", "msg": _("参数错误")}
+        ids = sorted(set(int(i) for i in ids))
+
+        q = self.session.query(ReviewChapter.id, ReviewChapter.title, ReviewChapter.alias, ReviewChapter.review_version)
+        chapters = q.filter(ReviewChapter.book_id == book_id).order_by(ReviewChapter.id).all()
+
+        # 一次聚合：未指定的章节只按章节汇总（段落号记为 -1），指定的章节按段落展开
+        t = SegmentReviewCount
+        segment = case((t.chapter_id.in_(ids), t.segment_id), else_=literal(-1)) if ids else literal(-1)
+        q = self.session.query(t.chapter_id, segment, func.sum(t.review_count))
+        q = q.filter(t.book_id == book_id).group_by(t.chapter_id, segment)
+
+        totals = {}
+        segments = {i: {} for i in ids}
+        for chapter_id, segment_id, cnt in q.all():
+            totals[chapter_id] = totals.get(chapter_id, 0) + cnt
+            if segment_id != -1:
+                segments[chapter_id][segment_id] = cnt
+
+        # 顺便缓存展开的章节，版本号在评论数之前随章节一起读出
+        versions = {c.id: c.review_version for c in chapters}
+        for chapter_id, counts in segments.items():
+            if chapter_id in versions:
+                SUMMARY_CACHE.set((book_id, chapter_id), (versions[chapter_id], counts))
+
+        # 紧凑的数组格式：[chapter_id, title, alias, review_num] / [segment_id, review_num]
+        data = {
+            "book_id": book_id,
+            "chapters": [[c.id, c.title, c.alias, totals.get(c.id, 0)] for c in chapters],
+            "segments": {str(k): sorted(v.items()) for k, v in segments.items()},
+        }
+        return {"err": "ok", "data": data}
+
+
 class ReviewList(BaseHandler):
     """获取某个段落的所有评论"""
 
@@ -62,11 +184,31 @@ class ReviewList(BaseHandler):
         if not book_id.isdigit() or not chapter_id.isdigit() or not segment_id.isdigit():
             return {"err": "params.invalid", "msg": _("参数错误")}
 
-        q = self.session.query(Review).filter(
+        page = get_page_args(self)
+        if page is None:
+            return {"err": "params.invalid", "msg": _("参数错误")}
+        limit, cursor = page
+
+        # 段落的 (评论数, 更新时间) 是主键查询，客户端缓存有效时就不必再查评论、序列化
+        version = SegmentReviewCount.version(self.session, int(book_id), int(chapter_id), int(segment_id))
+        user_id = self.current_user.id if self.current_user else 0
+        if self.check_etag("list", int(book_id), int(chapter_id), int(segment_id), version, limit, cursor, user_id):
+            return {"err": "ok"}
+
+        # 按楼层顺序，以 (level, id) 为游标翻页，翻到多深都只是一次索引范围扫描
+        q = with_full_dict(self.session.query(Review)).filter(
             Review.book_id == int(book_id), Review.chapter_id == int(chapter_id), Review.segment_id == int(segment_id)
         )
+        if cursor:
+            try:
+                level, review_id = int(cursor[0]), int(cursor[1])
+            except (TypeError, ValueError):
+                return {"err": "params.invalid", "msg": _("参数错误")}
+            q = q.filter(or_(Review.level > level, and_(Review.level == level, Review.id > review_id)))
+        q = q.order_by(Review.level, Review.id)
+        rows, next_cursor = fetch_page(q, limit, lambda row: (row.level, row.id))
 
-        data = [row.to_full_dict(self.current_user) for row in q.all()]
+        data = [row.to_full_dict(self.current_user) for row in rows]
 
         demo = {
             "reviewId": "1063367226805911552",
@@ -102,7 +244,7 @@ class ReviewList(BaseHandler):
             "rootReviewReplyCount": 0,
             "ipAddress": "上海",
         }
-        return {"err": "ok", "data": {"list": data}, "demo": demo}
+        return {"err": "ok", "data": {"list": data, "next_cursor": next_cursor}, "demo": demo}
 
 
 class ReviewAdd(BaseHandler):
@@ -129,58 +271,211 @@ class ReviewAdd(BaseHandler):
         if chapter is None:
             chapter = ReviewChapter(book_id=book_id, title=name, alias=chapter_name)
             self.session.add(chapter)
+            self.session.flush()
 
-        n = (
-            self.session.query(Review)
-            .filter(
-                Review.book_id == book_id,
-                Review.chapter_id == chapter.id,
-                Review.segment_id == data["segment_id"],
-            )
-            .count()
-        )
-
+        now = datetime.datetime.now()
         review = Review(**data)
-        review.level = n + 1
+        review.level = SegmentReviewCount.incr(self.session, int(book_id), chapter.id, int(data["segment_id"]), now)
         review.chapter_id = chapter.id
         review.geo = self.request.remote_ip
         review.user_id = self.current_user.id
-        review.create_time = datetime.datetime.now()
+        review.create_time = now
         review.update_time = review.create_time
         self.session.add(review)
 
-        if review.quote_id:
-            review.quote.update_time = datetime.datetime.now()
-            self.session.add(review.quote)
-
-        if review.root_id:
-            review.root.update_time = datetime.datetime.now()
-            self.session.add(review.root)
-
+        # 被回复的评论 update_time 变了，所在段落的列表版本也要更新
+        touched = {(int(book_id), chapter.id, int(data["segment_id"]))}
+        # review 还未 flush，review.quote / review.root 不会按外键懒加载，这里直接按 ID 取
+        parents = [self.session.get(Review, i) for i in {review.quote_id, review.root_id} - {None}]
+        for parent in parents:
+            if parent is None:
+                continue
+            parent.update_time = now
+            self.session.add(parent)
+            key = (parent.book_id, parent.chapter_id, parent.segment_id)
+            if key not in touched:
+                touched.add(key)
+                SegmentReviewCount.touch(self.session, *key, now)
+
+        self.session.flush()
+        recipients = ReviewInbox.deliver(self.session, review, parents)
+        search.index_review(self.session, review)
+
+        # 在提交之前登记，提交的过程中检查其他进程的新评论时，不会把这条评论算作其他进程的
+        FeedPoller.expect(int(book_id), chapter.id)
         if not self.commit():
+            FeedPoller.expect(int(book_id), chapter.id, -1)
             return {"err": "db.error", "msg": _(u"数据库操作异常，请重试")}
-        return {"err": "ok", "data": review.to_full_dict(self.current_user)}
+        for user_id in recipients:
+            publish_unread(self.session, user_id)
+        data = review.to_full_dict(self.current_user)
+        publish_review(review, data)
+        return {"err": "ok", "data": data}
 
 
 class ReviewMe(BaseHandler):
-    """获取「与我相关」的「最新」评论"""
+    """获取「与我相关」的未读评论：别人对我的引用、回复，最新的在前"""
 
     @js
     @auth
     def get(self):
-        is_count = self.get_argument("count", "").strip() != ""
-        last_read = self.current_user.last_read
-        q = self.session.query(Review).filter(Review.user_id == self.current_user.id)
-        if last_read:
-            q = q.filter(Review.update_time > last_read)
-        else:
-            q = q.filter(Review.update_time > Review.create_time)
+        user = self.current_user
+        last_read_id = read_watermark(self.session, user.id)
+        if self.get_argument("count", "").strip() != "":
+            return {"err": "ok", "data": {"count": unread_count(self.session, user.id, last_read_id)}}
+        q = self.session.query(ReviewInbox).filter(ReviewInbox.recipient_id == user.id, ReviewInbox.id > last_read_id)
+
+        page = get_page_args(self, cursor_size=1)
+        if page is None:
+            return {"err": "params.invalid", "msg": _("参数错误")}
+        limit, cursor = page
+
+        # 以收件箱的 id 为游标翻页
+        if cursor:
+            if not isinstance(cursor[0], int):
+                return {"err": "params.invalid", "msg": _("参数错误")}
+            q = q.filter(ReviewInbox.id < cursor[0])
+        review = joinedload(ReviewInbox.review)
+        q = q.options(review.joinedload(Review.user), review.joinedload(Review.quote).joinedload(Review.user))
+        rows, next_cursor = fetch_page(q.order_by(ReviewInbox.id.desc()), limit, lambda row: (row.id,))
+
+        data = []
+        for row in rows:
+            d = row.review.to_full_dict(self.current_user)
+            d["inboxId"] = row.id
+            data.append(d)
+        return {"err": "ok", "data": {"list": data, "next_cursor": next_cursor}}
+
+
+class ReviewMeRead(BaseHandler):
+    """「与我相关」标记为已读：默认全部已读，传 last_id（inboxId）时只到这一条为止；已读位置只前进不后退"""
+
+    @js
+    @auth
+    def post(self):
+        last_id = self.get_argument("last_id", "").strip()
+        if last_id and not last_id.isdigit():
+            return {"err": "params.invalid", "msg": _("参数错误")}
+
+        q = self.session.query(func.max(ReviewInbox.id)).filter(ReviewInbox.recipient_id == self.current_user.id)
+        if last_id:
+            q = q.filter(ReviewInbox.id <= int(last_id))
+        newest = q.scalar() or 0
+
+        user = self.live_user()
+        if newest > (user.last_read_id or 0):
+            user.last_read_id = newest
+            user.last_read = datetime.datetime.now()
+            if not self.commit():
+                return {"err": "db.error", "msg": _(u"数据库操作异常，请重试")}
+            # 同一用户的其他页面也要更新未读数
+            publish_unread(self.session, user.id, user.last_read_id)
+        return {"err": "ok", "data": {"last_read_id": user.last_read_id or 0}}
+
+
+class ReviewMeWait(BaseHandler):
+    """
+    长轮询「与我相关」的未读数：参数 count 是客户端已知的未读数，
+    与当前值不同时立即返回，否则等到有变化或超时（notify_poll_timeout 秒）再返回。
+    """
+
+    @js
+    @auth
+    async def get(self):
+        known = self.get_argument("count", "").strip()
+        if known and not known.isdigit():
+            return {"err": "params.invalid", "msg": _("参数错误")}
+
+        # 先订阅再查数量，查询期间发生的变化也不会漏掉
+        self.subscription = PubSub().subscribe(unread_channel(self.current_user.id))
+        try:
+            count = await self.run_db(unread_count, self.session, self.current_user.id)
+            await self.release_db()
+            if known and int(known) == count:
+                messages = await self.subscription.get(int(CONF.get("notify_poll_timeout", 30)))
+                if messages:
+                    count = messages[-1]["count"]
+        finally:
+            self.subscription.close()
+        return {"err": "ok", "data": {"count": count}}
+
+    def on_connection_close(self):
+        if getattr(self, "subscription", None):
+            self.subscription.close()
+
+
+class ReviewMeEvents(ReviewMeWait):
+    """
+    以 Server-Sent Events 推送「与我相关」的未读数（event: unread）：连上后先发一次当前值，
+    之后有新回复或标记已读时推送；每 notify_heartbeat 秒发一行注释保活。
+    """
+
+    async def get(self):
+        user = await self.run_db(lambda: self.current_user)
+        if not user:
+            self.set_status(400)
+            self.write({"err": "user.need_login", "msg": _(u"请先登录")})
+            return
+
+        self.subscription = PubSub().subscribe(unread_channel(user.id))
+        try:
+            count = await self.run_db(unread_count, self.session, user.id)
+            await self.release_db()
+            self.set_header("Content-Type", "text/event-stream; charset=UTF-8")
+            self.set_header("Cache-Control", "no-cache")
+            self.set_header("X-Accel-Buffering", "no")  # 让 nginx 不缓冲
+            self.write("retry: 5000\n\n")
+            heartbeat = int(CONF.get("notify_heartbeat", 25))
+            while not self.subscription.closed:
+                self.write(b"event: unread\ndata: " + encode_json({"count": count}) + b"\n\n")
+                await self.flush()
+                messages = await self.subscription.get(heartbeat)
+                while not messages and not self.subscription.closed:
+                    self.write(": ping\n\n")
+                    await self.flush()
+                    messages = await self.subscription.get(heartbeat)
+                if messages:
+                    count = messages[-1]["count"]
+        except StreamClosedError:
+            pass
+        finally:
+            self.subscription.close()
+
+
+class ReviewSearch(BaseHandler):
+    """按关键字搜索评论，可以限定书籍、章节；最新的在前"""
 
-        if is_count:
-            return {"err": "ok", "data": {"count": q.count()}}
+    @js
+    def get(self):
+        query = super_strip(self.get_argument("q", ""))
+        book_id = self.get_argument("book_id", "").strip()
+        chapter_id = self.get_argument("chapter_id", "").strip()
+        if not query or not (book_id or "0").isdigit() or not (chapter_id or "0").isdigit():
+            return {"err": "params.invalid", "msg": _("参数错误")}
+        if not search.supported(self.session.get_bind().dialect.name):
+            return {"err": "search.unsupported", "msg": _("当前数据库不支持搜索")}
 
-        data = [row.to_full_dict(self.current_user) for row in q.all()]
-        return {"err": "ok", "data": {"list": data}}
+        page = get_page_args(self, cursor_size=1)
+        if page is None:
+            return {"err": "params.invalid", "msg": _("参数错误")}
+        limit, cursor = page
+
+        q, order = search.search_query(self.session, query)
+        if q is None:
+            return {"err": "ok", "data": {"list": [], "next_cursor": ""}}
+        if book_id:
+            q = q.filter(Review.book_id == int(book_id))
+        if chapter_id:
+            q = q.filter(Review.chapter_id == int(chapter_id))
+        if cursor:
+            if not isinstance(cursor[0], int):
+                return {"err": "params.invalid", "msg": _("参数错误")}
+            q = q.filter(order < cursor[0])
+        q = with_full_dict(q).order_by(order.desc())
+        rows, next_cursor = fetch_page(q, limit, lambda row: (row.id,))
+
+        data = [row.to_full_dict(self.current_user) for row in rows]
+        return {"err": "ok", "data": {"list": data, "next_cursor": next_cursor}}
 
 
 class ReviewGetBook(BaseHandler):
@@ -197,7 +492,10 @@ class ReviewGetBook(BaseHandler):
         if row:
             return {"err": "ok", "data": row.to_dict()}
 
-        row = self.session.query(ReviewBook).filter(ReviewBook.alias.like(f"%{title}%")).first()
+        # 按规范化后的别名查找，走 review_book_aliases 的索引
+        alias = ReviewBookAlias.normalize(title)
+        q = self.session.query(ReviewBook).join(ReviewBookAlias, ReviewBookAlias.book_id == ReviewBook.id)
+        row = q.filter(ReviewBookAlias.alias == alias).first()
         if row:
             return {"err": "ok", "data": row.to_dict()}
 
@@ -205,6 +503,9 @@ class ReviewGetBook(BaseHandler):
         row.title = title
         row.alias = title
         self.session.add(row)
+        self.session.flush()
+        for name in ReviewBookAlias.split(row.alias):
+            self.session.add(ReviewBookAlias(book_id=row.id, alias=name))
 
         if not self.commit():
             return {"err": "db.error", "msg": _(u"数据库操作异常，请重试")}
@@ -215,7 +516,12 @@ def routes():
     return [
         (r"/api/review/book", ReviewGetBook),
         (r"/api/review/summary", ReviewSummary),
+        (r"/api/review/book_summary", ReviewBookSummary),
         (r"/api/review/list", ReviewList),
         (r"/api/review/add", ReviewAdd),
         (r"/api/review/me", ReviewMe),
+        (r"/api/review/me/read", ReviewMeRead),
+        (r"/api/review/me/wait", ReviewMeWait),
+        (r"/api/review/me/events", ReviewMeEvents),
+        (r"/api/review/search", ReviewSearch),
     ]
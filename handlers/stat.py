@@ -1,31 +1,72 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
-from handlers.base import BaseHandler
+from handlers.base import READER_CACHE, BaseHandler, js
+from handlers.review import SUMMARY_CACHE
 import loader
-import models
+from services.counters import StatCounters
+from services.metrics import CONTENT_TYPE, Metrics
+from services.password import PasswordService
 
 CONF = loader.get_settings()
 
 
 class SystemStat(BaseHandler):
-    def get(self):
-        book_count = self.session.query(models.ReviewBook).count()
-        chapter_count = self.session.query(models.ReviewChapter).count()
-        review_count = self.session.query(models.Review).count()
-        reader_count = self.session.query(models.Reader).count()
+    async def stats(self):
+        counters = StatCounters()
+        if not counters.loaded():
+            # 后台线程还没有完成第一次统计
+            await self.run_db(counters.refresh, self.session)
+        return {
+            "count": counters.data(),
+            "summary_cache": SUMMARY_CACHE.stats(),
+            "reader_cache": READER_CACHE.stats(),
+            "password": PasswordService().stats(),
+        }
+
+    async def get(self):
+        d = await self.stats()
+        count = d["count"]
+        cache = d["summary_cache"]
+        password = d["password"]
 
         out = f"""[Stat]
-Reader:  {reader_count}
-Book:    {book_count}
-Chapter: {chapter_count}
-Reviews: {review_count}
+Reader:  {count["reader"]}
+Book:    {count["book"]}
+Chapter: {count["chapter"]}
+Reviews: {count["review"]}
+
+[SummaryCache]
+Size:      {cache["size"]}/{cache["maxsize"]}
+Hits:      {cache["hits"]}
+Misses:    {cache["misses"]}
+Evictions: {cache["evictions"]}
+
+[Password]
+Workers:   {password["workers"]}
+Pending:   {password["pending"]}
+CacheSize: {password["cache"]["size"]}
+CacheHits: {password["cache"]["hits"]}
 """
         self.write(out)
         return
 
 
+class SystemStatJson(SystemStat):
+    @js
+    async def get(self):
+        return {"err": "ok", "data": await self.stats()}
+
+
+class MetricsHandler(BaseHandler):
+    def get(self):
+        self.set_header("Content-Type", CONTENT_TYPE)
+        self.write(Metrics().render())
+
+
 def routes():
     return [
         (r"/", SystemStat),
+        (r"/api/stat", SystemStatJson),
+        (r"/metrics", MetricsHandler),
     ]
@@ -11,6 +11,7 @@ from gettext import gettext as _
 
 import loader
 from services.mail import MailService
+from services.password import PasswordService
 from handlers.base import BaseHandler, auth, js
 from models import Reader
 
@@ -20,12 +21,13 @@ CONF = loader.get_settings()
 class UserUpdate(BaseHandler):
     @js
     @auth
-    def post(self):
+    async def post(self):
         data = tornado.escape.json_decode(self.request.body)
-        user = self.current_user
+        user = await self.run_db(self.live_user)
         # 确保user不是None
         if not user:
             return {"err": "user.need_login", "msg": _(u"请先登录")}
+        await self.release_db()
 
         nickname = data.get("nickname", "")
         if nickname:
@@ -38,18 +40,21 @@ class UserUpdate(BaseHandler):
         p0 = data.get("password0", "").strip()
         p1 = data.get("password1", "").strip()
         if len(p0) > 0:
-            if not user.get_secure_password(p0):
+            if not await PasswordService().check(user, p0):
                 return {"err": "params.password.error", "msg": _(u"密码错误")}
             if len(p1) < 8 or len(p1) > 20 or not re.match(Reader.RE_PASSWORD, p1):
                 return {"err": "params.password.invalid", "msg": _(u"密码无效")}
             logging.info(f'{user.nickname} 更改密码')
-            user.set_secure_password(p1)
+            await PasswordService().set_password(user, p1)
 
-        self.session.add(user)
+        def save():
+            self.session.add(user)
+            return user.data() if self.commit() else None
 
-        if not self.commit():
+        data = await self.run_db(save)
+        if data is None:
             return {"err": "db.error", "msg": _(u"数据库操作异常，请重试")}
-        return {"err": "ok", "data": user.data()}
+        return {"err": "ok", "data": data}
 
 
 class SignUp(BaseHandler):
@@ -103,22 +108,26 @@ class SignUp(BaseHandler):
 
 class SignIn(BaseHandler):
     @js
-    def post(self):
+    async def post(self):
         email = self.get_argument("email", "").strip().lower()
         password = self.get_argument("password", "").strip()
         if not email or not password:
             return {"err": "params.invalid", "msg": _(u"邮箱或密码错误")}
-        user = self.session.query(Reader).filter(Reader.email == email).first()
+        user = await self.run_db(lambda: self.session.query(Reader).filter(Reader.email == email).first())
         if not user:
             return {"err": "params.no_user", "msg": _(u"无此用户")}
-        if not user.get_secure_password(password):
+        await self.release_db()
+        if not await PasswordService().check(user, password):
             return {"err": "params.invalid", "msg": _(u"用户名或密码错误")}
         if not user.can_login():
             return {"err": "permission", "msg": _(u"无权登录")}
         logging.debug("PERM = %s", user.permission)
 
-        self.login_user(user)
-        return {"err": "ok", "msg": "ok", "data": user.data()}
+        def login():
+            self.login_user(user)
+            return user.data()
+
+        return {"err": "ok", "msg": "ok", "data": await self.run_db(login)}
 
 
 class UserReset(SignUp):
@@ -5,23 +5,35 @@ import logging
 import os
 import re
 import sys
+import tempfile
 from gettext import gettext as _
 
 import tornado.httpserver
 import tornado.ioloop
 import tornado.log
+import tornado.netutil
+import tornado.process
 from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
 from tornado import web
 from tornado.options import define, options
 
-import loader, models, handlers
+import loader, models, handlers, migrations
+from handlers.feed import FeedPoller
 from services import AsyncService
+from services import metrics, sqlstats
+from services.counters import StatCounters
 
 CONF = loader.get_settings()
 define("host", default="", type=str, help=_("The host address on which to listen"))
 define("port", default=8080, type=int, help=_("The port on which to listen."))
 define("syncdb", default=False, type=bool, help=_("Create all tables"))
+define("migrate", default=False, type=bool, help=_("Run pending schema migrations"))
+define("explain", default=False, type=bool, help=_("Print query plans of the handler queries"))
+define("rebuild_counters", default=False, type=bool, help=_("Rebuild segment review counts from reviews"))
+define("workers", default=1, type=int, help=_("Number of worker processes, 0 means one per CPU core"))
+define("reuse_port", default=True, type=bool, help=_("Each worker binds its own SO_REUSEPORT socket"))
+define("max_restarts", default=100, type=int, help=_("How many times crashed workers are restarted"))
 
 
 def safe_filename(filename):
@@ -41,6 +53,13 @@ def bind_topdir_book_names(cache):
     return
 
 
+def async_db_url(url):
+    """把同步驱动的数据库地址换成对应的异步驱动，例如 sqlite:// -> sqlite+aiosqlite://"""
+    scheme, rest = url.split("://", 1)
+    drivers = CONF.get("db_async_drivers", {})
+    return drivers.get(scheme, scheme) + "://" + rest
+
+
 def make_app():
     auth_db_path = CONF["user_database"]
     logging.debug("Init AuthDB  with [%s]" % auth_db_path)
@@ -48,23 +67,67 @@ def make_app():
     # build sql session factory
     engine = create_engine(auth_db_path, **CONF["db_engine_args"])
     ScopedSession = scoped_session(sessionmaker(bind=engine, autoflush=True, autocommit=False))
+    sqlstats.instrument(engine)
+    sqlstats.setup_slow_log(CONF.get("slow_query_log", ""))
 
     if options.syncdb:
         models.user_syncdb(engine)
+        migrations.migrate(engine)
         logging.info("Create tables into DB")
         sys.exit(0)
 
+    if options.migrate:
+        migrations.print_query_plans(engine, "Before migration")
+        versions = migrations.migrate(engine)
+        logging.info("Applied migrations: %s", versions)
+        migrations.print_query_plans(engine, "After migration")
+        sys.exit(0)
+
+    if options.explain:
+        migrations.print_query_plans(engine, "Query plans")
+        sys.exit(0)
+
+    if options.rebuild_counters:
+        with engine.begin() as conn:
+            n = migrations.rebuild_segment_counts(conn)
+        logging.info("Rebuild review counts of %d segments", n)
+        sys.exit(0)
+
     app_settings = dict(CONF)
     app_settings.update(
         {
             "ScopedSession": ScopedSession,
         }
     )
+    if options.workers != 1:
+        # 多进程模式下不能使用自动重载
+        app_settings["autoreload"] = False
+
+    # 异步模式：接口的数据库访问走 AsyncSession，不阻塞 IOLoop；后台服务和命令行仍使用同步引擎
+    async_engine = None
+    if CONF.get("db_async", False):
+        from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+        async_engine = create_async_engine(async_db_url(auth_db_path), **CONF["db_engine_args"])
+        app_settings["AsyncSession"] = async_sessionmaker(bind=async_engine, autoflush=True)
+        sqlstats.instrument(async_engine.sync_engine)
+        logging.info("Init async DB with [%s]" % str(async_engine.url))
 
     logging.info("Now, Running...")
     AsyncService().setup(ScopedSession)
+    StatCounters().start(ScopedSession, int(CONF.get("stat_refresh_interval", 300)))
+    engines = {"sync": engine}
+    if async_engine is not None:
+        engines["async"] = async_engine.sync_engine
+    metrics.pool_gauges(engines)
+    metrics.service_gauges()
     app = web.Application(handlers.routes(), **app_settings)
+    if CONF.get("compress_encodings"):
+        from handlers.compress import CompressContentEncoding
+
+        app.add_transform(CompressContentEncoding)
     app._engine = engine
+    app._async_engine = async_engine
     return app
 
 
@@ -95,12 +158,41 @@ def setup_logging():
         logger.addHandler(console_handler)
 
 
+def is_command():
+    return options.syncdb or options.migrate or options.explain or options.rebuild_counters
+
+
+def metrics_dir():
+    return CONF.get("metrics_dir") or os.path.join(tempfile.gettempdir(), "review-metrics-%d" % options.port)
+
+
 def start_server():
     """启动服务器的核心逻辑"""
     logging.info("Starting server initialization...")
 
+    sockets, task_id = None, None
+    if options.workers != 1 and not is_command():
+        # 多进程模式：先 fork 再创建应用，数据库引擎、连接池和后台线程都不能从父进程继承。
+        # 父进程留下来监控子进程，子进程异常退出时会被重新拉起。
+        if not options.reuse_port:
+            sockets = tornado.netutil.bind_sockets(options.port, options.host)
+        metrics.prepare_directory(metrics_dir())
+        task_id = tornado.process.fork_processes(options.workers, max_restarts=options.max_restarts)
+        logging.info("Worker %d started, pid=%d", task_id, os.getpid())
+        if sockets is None:
+            sockets = tornado.netutil.bind_sockets(options.port, options.host, reuse_port=True)
+
     # 创建应用
     app = make_app()
+    if task_id is not None:
+        # 各进程的指标带上 worker 标签，并定时写入共享目录，/metrics 合并输出全部进程的指标
+        metrics.Metrics().setup(task_id, metrics_dir())
+        interval = float(CONF.get("metrics_dump_interval", 5))
+        tornado.ioloop.PeriodicCallback(metrics.Metrics().dump, interval * 1000).start()
+        # 新评论只推给同一进程内的 WebSocket 连接，其他进程的变化靠定时检查
+        poll_interval = float(CONF.get("feed_poll_interval", 2))
+        if poll_interval > 0:
+            FeedPoller(app.settings["ScopedSession"], app.settings.get("AsyncSession")).start(poll_interval)
 
     # 创建HTTP服务器
     http_server = tornado.httpserver.HTTPServer(
@@ -110,7 +202,10 @@ def start_server():
     )
 
     # 绑定端口
-    http_server.listen(options.port, options.host)
+    if sockets:
+        http_server.add_sockets(sockets)
+    else:
+        http_server.listen(options.port, options.host)
     logging.info(f"Server started successfully on {options.host or '0.0.0.0'}:{options.port}")
     logging.info("Press Ctrl+C to stop the server")
 
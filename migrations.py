@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+数据库的版本化迁移
+
+create_all 只会创建不存在的表，不会给已有的表加索引、加字段。这里按版本号顺序
+执行迁移，执行过的版本记录在 schema_migrations 表里，重复执行是安全的。
+
+    python3 main.py --migrate      # 执行迁移，并打印前后的查询计划
+    python3 main.py --explain      # 只打印各接口查询的查询计划
+    python3 main.py --rebuild_counters  # 按 reviews 重建段落评论数
+"""
+
+import datetime
+import logging
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, delete, func, inspect, or_, select
+from sqlalchemy.schema import CreateIndex
+
+import search
+from models import Base, Reader, Review, ReviewBook, ReviewBookAlias, ReviewChapter, ReviewInbox, SegmentReviewCount
+from models import iter_pages
+
+_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    _metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String(255), default=""),
+    Column("apply_time", DateTime),
+)
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    def register(step):
+        MIGRATIONS.append((version, name, step))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return step
+
+    return register
+
+
+def get_index(table, name):
+    return next(i for i in table.indexes if i.name == name)
+
+
+def create_index_online(conn, index):
+    """创建索引（已存在则跳过）。MySQL 下使用 INPLACE 方式，建索引期间不锁表"""
+    names = [i["name"] for i in inspect(conn).get_indexes(index.table.name)]
+    if index.name in names:
+        return False
+    sql = str(CreateIndex(index).compile(dialect=conn.dialect))
+    if conn.dialect.name == "mysql":
+        sql += " ALGORITHM=INPLACE LOCK=NONE"
+    logging.info("create index: %s", sql)
+    conn.exec_driver_sql(sql)
+    return True
+
+
+def add_column_online(conn, column):
+    """给已有的表加字段（已存在则跳过），新字段允许为空"""
+    names = [c["name"] for c in inspect(conn).get_columns(column.table.name)]
+    if column.name in names:
+        return False
+    sql = "ALTER TABLE %s ADD COLUMN %s %s" % (column.table.name, column.name, column.type.compile(dialect=conn.dialect))
+    if conn.dialect.name == "mysql":
+        sql += ", ALGORITHM=INPLACE, LOCK=NONE"
+    logging.info("add column: %s", sql)
+    conn.exec_driver_sql(sql)
+    return True
+
+
+@migration(1, "add indexes for review queries")
+def add_review_indexes(conn):
+    for table, name in [
+        (Review.__table__, "ix_reviews_segment"),
+        (Review.__table__, "ix_reviews_user_update"),
+        (Review.__table__, "ix_reviews_root"),
+        (ReviewChapter.__table__, "ix_review_chapters_book_title"),
+        (ReviewChapter.__table__, "ix_review_chapters_book_alias"),
+        (ReviewBook.__table__, "ix_review_books_title"),
+    ]:
+        create_index_online(conn, get_index(table, name))
+
+
+@migration(2, "build segment_review_counts")
+def build_segment_counts(conn):
+    rebuild_segment_counts(conn)
+
+
+def rebuild_segment_counts(conn):
+    """按 reviews 重新生成 segment_review_counts，用于初始化或修正计数，返回段落数"""
+    t = SegmentReviewCount.__table__
+    cols = [Review.book_id, Review.chapter_id, Review.segment_id]
+    conn.execute(delete(t))
+    fields, columns = [func.count()], [t.c.book_id, t.c.chapter_id, t.c.segment_id, t.c.review_count]
+    # 执行第 2 版迁移时还没有 update_time 字段，由第 5 版加上字段后再重建一次
+    if "update_time" in [c["name"] for c in inspect(conn).get_columns(t.name)]:
+        fields.append(func.max(Review.update_time))
+        columns.append(t.c.update_time)
+    q = select(*cols, *fields).group_by(*cols)
+    conn.execute(t.insert().from_select(columns, q))
+    # 计数可能变了，各进程缓存的段落评论数都要失效；第 8 版迁移之前还没有 review_version 字段
+    c = ReviewChapter.__table__
+    if "review_version" in [col["name"] for col in inspect(conn).get_columns(c.name)]:
+        conn.execute(c.update().values(review_version=func.coalesce(c.c.review_version, 0) + 1))
+    return conn.execute(select(func.count()).select_from(t)).scalar()
+
+
+@migration(3, "split review_books.alias into review_book_aliases")
+def build_book_aliases(conn):
+    rebuild_book_aliases(conn)
+
+
+def rebuild_book_aliases(conn, batch_size=1000):
+    """把 review_books 的书名和 alias 拆分成 review_book_aliases，返回别名数"""
+    t = ReviewBookAlias.__table__
+    conn.execute(delete(t))
+    total = 0
+    for page in iter_pages(conn, ReviewBook.id, ReviewBook.title, ReviewBook.alias, batch_size=batch_size):
+        rows = []
+        for book_id, title, alias in page:
+            for name in ReviewBookAlias.split((title or "") + "\n" + (alias or "")):
+                rows.append({"book_id": book_id, "alias": name})
+        if rows:
+            conn.execute(t.insert(), rows)
+            total += len(rows)
+    return total
+
+
+@migration(4, "full-text index on review content")
+def build_review_search(conn):
+    search.create_index(conn)
+
+
+@migration(5, "segment_review_counts.update_time as the version of review lists")
+def add_segment_update_time(conn):
+    add_column_online(conn, SegmentReviewCount.__table__.c.update_time)
+    rebuild_segment_counts(conn)
+
+
+@migration(6, "review_inbox for replies, readers.last_read_id as the read watermark")
+def build_review_inbox(conn):
+    add_column_online(conn, Reader.__table__.c.last_read_id)
+    rebuild_review_inbox(conn)
+
+
+def rebuild_review_inbox(conn):
+    """
+    按 reviews 的引用、回复关系重新生成 review_inbox，返回收件数。
+    收件箱的 id 按评论先后分配；readers.last_read 之前的评论算作已读，换算成 last_read_id。
+    """
+    t = ReviewInbox.__table__
+    conn.execute(delete(t))
+    reply, parent = Review.__table__.alias("reply"), Review.__table__.alias("parent")
+    q = (
+        select(reply.c.id, parent.c.user_id, reply.c.create_time)
+        .select_from(reply.join(parent, or_(parent.c.id == reply.c.quote_id, parent.c.id == reply.c.root_id)))
+        .where(parent.c.user_id != reply.c.user_id)
+        .distinct()
+        .order_by(reply.c.id, parent.c.user_id)
+    )
+    conn.execute(t.insert().from_select([t.c.review_id, t.c.recipient_id, t.c.create_time], q))
+
+    r = Reader.__table__
+    watermark = (
+        select(func.coalesce(func.max(t.c.id), 0))
+        .where(t.c.recipient_id == r.c.id, t.c.create_time <= r.c.last_read)
+        .scalar_subquery()
+    )
+    conn.execute(r.update().values(last_read_id=watermark))
+    return conn.execute(select(func.count()).select_from(t)).scalar()
+
+
+@migration(7, "index single CJK characters in review_fts")
+def reindex_review_search(conn):
+    if conn.dialect.name == "sqlite":
+        search.rebuild_index(conn)
+
+
+@migration(8, "review_chapters.review_version as the version of segment review counts")
+def add_chapter_review_version(conn):
+    add_column_online(conn, ReviewChapter.__table__.c.review_version)
+    t = ReviewChapter.__table__
+    conn.execute(t.update().values(review_version=0))
+
+
+def applied_versions(conn):
+    _metadata.create_all(conn)
+    return set(conn.execute(select(schema_migrations.c.version)).scalars())
+
+
+def migrate(engine):
+    """执行所有未执行的迁移，返回本次执行的版本号列表"""
+    Base.metadata.create_all(engine)
+    done = []
+    with engine.connect() as conn:
+        applied = applied_versions(conn)
+        conn.commit()
+
+    for version, name, step in MIGRATIONS:
+        if version in applied:
+            continue
+        logging.info("migrate to version %d: %s", version, name)
+        with engine.begin() as conn:
+            step(conn)
+            conn.execute(
+                schema_migrations.insert().values(version=version, name=name, apply_time=datetime.datetime.now())
+            )
+        done.append(version)
+    return done
+
+
+def handler_queries():
+    """各个接口实际执行的查询，用于对比建索引前后的查询计划"""
+    book_id, chapter_id, segment_id, user_id = 1, 1, 1, 1
+    return [
+        (
+            "ReviewSummary: chapter",
+            select(ReviewChapter)
+            .where(ReviewChapter.book_id == book_id)
+            .where(or_(ReviewChapter.title == "title", ReviewChapter.alias == "alias"))
+            .limit(1),
+        ),
+        (
+            "ReviewSummary: count",
+            select(SegmentReviewCount.segment_id, SegmentReviewCount.review_count).where(
+                SegmentReviewCount.book_id == book_id, SegmentReviewCount.chapter_id == chapter_id
+            ),
+        ),
+        (
+            "ReviewBookSummary",
+            select(SegmentReviewCount.chapter_id, func.sum(SegmentReviewCount.review_count))
+            .where(SegmentReviewCount.book_id == book_id)
+            .group_by(SegmentReviewCount.chapter_id),
+        ),
+        (
+            "ReviewList",
+            select(Review)
+            .where(Review.book_id == book_id, Review.chapter_id == chapter_id, Review.segment_id == segment_id)
+            .order_by(Review.level, Review.id)
+            .limit(50),
+        ),
+        (
+            "ReviewAdd: level",
+            select(SegmentReviewCount).where(
+                SegmentReviewCount.book_id == book_id,
+                SegmentReviewCount.chapter_id == chapter_id,
+                SegmentReviewCount.segment_id == segment_id,
+            ),
+        ),
+        ("Review.all_reply", select(Review).where(Review.root_id == 1)),
+        (
+            "ReviewMe: count",
+            select(func.count()).where(ReviewInbox.recipient_id == user_id, ReviewInbox.id > 0),
+        ),
+        (
+            "ReviewMe",
+            select(ReviewInbox)
+            .where(ReviewInbox.recipient_id == user_id, ReviewInbox.id > 0)
+            .order_by(ReviewInbox.id.desc())
+            .limit(50),
+        ),
+        ("ReviewGetBook: title", select(ReviewBook).where(ReviewBook.title == "title").limit(1)),
+        (
+            "ReviewGetBook: alias",
+            select(ReviewBookAlias.book_id).where(ReviewBookAlias.alias == "title").limit(1),
+        ),
+    ]
+
+
+def explain(conn, stmt):
+    compiled = stmt.compile(dialect=conn.dialect)
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[k] for k in compiled.positiontup)
+    prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    return conn.exec_driver_sql(prefix + str(compiled), params).fetchall()
+
+
+def print_query_plans(engine, title):
+    print("==== %s ====" % title)
+    with engine.connect() as conn:
+        for name, stmt in handler_queries():
+            print("-- %s" % name)
+            for row in explain(conn, stmt):
+                print("   ", " | ".join(str(v) for v in row))
@@ -2,10 +2,11 @@
 # -*- coding: UTF-8 -*-
 
 import bcrypt
+import datetime
 import re
 import logging
 
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, String
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Index, Integer, String, func, select, update
 from sqlalchemy.orm import relationship, declarative_base
 
 import loader
@@ -49,6 +50,7 @@ class Reader(Base):
     update_time = Column(DateTime)
     access_time = Column(DateTime)
     last_read = Column(DateTime)
+    last_read_id = Column(Integer, default=0)  # 「与我相关」的已读位置：review_inbox.id
 
     def __str__(self):
         return "<id=%d, email=%s>" % (self.id, self.email)
@@ -63,19 +65,27 @@ class Reader(Base):
         self.set_secure_password(p)
         return p
 
-    def get_secure_password(self, raw_password):
+    @staticmethod
+    def check_password_hash(hashed, raw_password):
         # 使用bcrypt验证密码
-        if not self.password:
+        if not hashed:
             return False
         try:
-            return bcrypt.checkpw(raw_password.encode('UTF-8'), self.password.encode('UTF-8'))
+            return bcrypt.checkpw(raw_password.encode('UTF-8'), hashed.encode('UTF-8'))
         except Exception as e:
             logging.error(f"Password verification error: {e}")
             return False
 
-    def set_secure_password(self, raw_password):
+    @staticmethod
+    def make_password_hash(raw_password):
         # 使用bcrypt哈希密码，自动生成盐值
-        self.password = bcrypt.hashpw(raw_password.encode('UTF-8'), bcrypt.gensalt()).decode('UTF-8')
+        return bcrypt.hashpw(raw_password.encode('UTF-8'), bcrypt.gensalt()).decode('UTF-8')
+
+    def get_secure_password(self, raw_password):
+        return Reader.check_password_hash(self.password, raw_password)
+
+    def set_secure_password(self, raw_password):
+        self.password = Reader.make_password_hash(raw_password)
 
     def set_permission(self, operations):
         ALL = "delprsuv"
@@ -143,6 +153,33 @@ class ReviewBook(Base):
     title = Column(String(255), default="")
     alias = Column(String(5120), default="")
 
+    __table_args__ = (Index("ix_review_books_title", "title"),)
+
+
+class ReviewBookAlias(Base):
+    """书籍别名，每个别名一行，规范化后建索引，按书名查找书籍时只需一次索引查找"""
+
+    __tablename__ = "review_book_aliases"
+    id = Column(Integer, primary_key=True)
+    book_id = Column(Integer, default=0)
+    alias = Column(String(255), default="")
+
+    __table_args__ = (Index("ix_review_book_aliases_alias", "alias", "book_id"),)
+
+    RE_SEPARATOR = r"[|\n]"  # ReviewBook.alias 中多个别名的分隔符
+
+    @staticmethod
+    def normalize(title):
+        s = title.replace("\u3000", " ")  # 替换全角空格
+        s = re.sub(r"\s+", " ", s)  # 多个空格合并为一个
+        s = "".join(c for c in s.strip() if c.isprintable())
+        return s.lower()[:255]
+
+    @staticmethod
+    def split(alias):
+        names = (ReviewBookAlias.normalize(s) for s in re.split(ReviewBookAlias.RE_SEPARATOR, alias or ""))
+        return sorted(set(n for n in names if n))
+
 
 class ReviewChapter(Base):
     __tablename__ = "review_chapters"
@@ -151,6 +188,13 @@ class ReviewChapter(Base):
     title = Column(String(255), default="")  # 章节名称，例如「第一章 绯红」
     alias = Column(String(5120), default="")  # 章节别名，例如「第一章 绯红（求月票）」
     parents = Column(String(5120), default="")  # 父章节名，例如「第一部 小丑」
+    review_version = Column(Integer, default=0)  # 章节内评论数每变化一次加一，段落评论数缓存和 ETag 的版本号
+
+    __table_args__ = (
+        Index("ix_review_chapters_book_title", "book_id", "title"),
+        # MySQL 的索引长度有限，alias 只索引前缀
+        Index("ix_review_chapters_book_alias", "book_id", "alias", mysql_length={"alias": 191}),
+    )
 
     @staticmethod
     def clean_title(title):
@@ -159,6 +203,12 @@ class ReviewChapter(Base):
         s = re.sub("[（（【].*[】））]", "", s)  # 删掉括号里的内容
         return s
 
+    @classmethod
+    def bump_version(cls, session, chapter_id):
+        t = cls.__table__
+        version = func.coalesce(t.c.review_version, 0) + 1
+        session.execute(update(t).where(t.c.id == chapter_id).values(review_version=version))
+
 
 class Review(Base):
     __tablename__ = "reviews"
@@ -202,6 +252,12 @@ class Review(Base):
     like_count = Column(Integer, default=0)
     dislike_count = Column(Integer, default=0)
 
+    __table_args__ = (
+        Index("ix_reviews_segment", "book_id", "chapter_id", "segment_id", "level"),
+        Index("ix_reviews_user_update", "user_id", "update_time"),
+        Index("ix_reviews_root", "root_id"),
+    )
+
     def to_full_dict(self, current_user=None):
         row = self
         d = {}
@@ -235,5 +291,128 @@ class Review(Base):
         return d
 
 
+class SegmentReviewCount(Base):
+    """
+    段落的评论数，和评论在同一个事务里更新，读取时无需对 reviews 做聚合。
+    (review_count, update_time) 同时作为段落评论列表的版本号，用于生成 ETag。
+    """
+
+    __tablename__ = "segment_review_counts"
+    book_id = Column(Integer, primary_key=True, autoincrement=False)
+    chapter_id = Column(Integer, primary_key=True, autoincrement=False)
+    segment_id = Column(Integer, primary_key=True, autoincrement=False)
+    review_count = Column(Integer, default=0)
+    update_time = Column(DateTime)  # 段落内评论最后一次新增或更新的时间
+
+    @classmethod
+    def incr(cls, session, book_id, chapter_id, segment_id, now=None):
+        """
+        段落评论数原子地加一，返回加一后的值（即新评论的楼层号）。
+
+        用一条 upsert 语句完成，计数行在事务提交前一直被锁住，多进程并发写入
+        同一段落时也不会分配出重复的楼层。章节的 review_version 在同一个事务里加一。
+        """
+        ReviewChapter.bump_version(session, chapter_id)
+        t = cls.__table__
+        key = dict(book_id=book_id, chapter_id=chapter_id, segment_id=segment_id)
+        dialect = session.get_bind().dialect.name
+        now = now or datetime.datetime.now()
+
+        if dialect in ("sqlite", "postgresql"):
+            if dialect == "sqlite":
+                from sqlalchemy.dialects.sqlite import insert
+            else:
+                from sqlalchemy.dialects.postgresql import insert
+            stmt = insert(t).values(review_count=1, update_time=now, **key)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[t.c.book_id, t.c.chapter_id, t.c.segment_id],
+                set_={"review_count": t.c.review_count + 1, "update_time": now},
+            )
+            return session.execute(stmt.returning(t.c.review_count)).scalar()
+
+        if dialect == "mysql":
+            # MySQL 没有 RETURNING，借助 LAST_INSERT_ID(expr) 在本连接内带回新值
+            from sqlalchemy.dialects.mysql import insert
+
+            stmt = insert(t).values(review_count=func.last_insert_id(1), update_time=now, **key)
+            stmt = stmt.on_duplicate_key_update(
+                review_count=func.last_insert_id(t.c.review_count + 1), update_time=now
+            )
+            session.execute(stmt)
+            return session.execute(select(func.last_insert_id())).scalar()
+
+        row = session.query(cls).filter_by(**key).with_for_update().first()
+        if row is None:
+            row = cls(review_count=0, **key)
+            session.add(row)
+        row.review_count += 1
+        row.update_time = now
+        session.flush()
+        return row.review_count
+
+    @classmethod
+    def touch(cls, session, book_id, chapter_id, segment_id, now):
+        """段落中已有的评论被修改（例如被回复）时更新版本"""
+        t = cls.__table__
+        stmt = update(t).where(t.c.book_id == book_id, t.c.chapter_id == chapter_id, t.c.segment_id == segment_id)
+        session.execute(stmt.values(update_time=now))
+
+    @classmethod
+    def chapter_counts(cls, session, book_id, chapter_id):
+        """返回章节的 {段落 ID: 评论数}"""
+        q = session.query(cls.segment_id, cls.review_count)
+        return dict(q.filter_by(book_id=book_id, chapter_id=chapter_id).all())
+
+    @classmethod
+    def version(cls, session, book_id, chapter_id, segment_id):
+        """返回段落的 (评论数, 最后更新时间)，没有评论时为 (0, None)"""
+        q = session.query(cls.review_count, cls.update_time)
+        row = q.filter_by(book_id=book_id, chapter_id=chapter_id, segment_id=segment_id).first()
+        return tuple(row) if row else (0, None)
+
+
+class ReviewInbox(Base):
+    """
+    「与我相关」的收件箱：新评论引用或回复了谁的评论，就在谁的收件箱里写一行。
+    按 (recipient_id, id) 查询，未读数和列表都只扫描索引；已读位置记在 Reader.last_read_id。
+    """
+
+    __tablename__ = "review_inbox"
+    id = Column(Integer, primary_key=True)
+    recipient_id = Column(Integer, ForeignKey("readers.id"))
+    review_id = Column(Integer, ForeignKey("reviews.id"))
+    create_time = Column(DateTime)
+
+    review = relationship("Review")
+
+    __table_args__ = (Index("ix_review_inbox_recipient", "recipient_id", "id"),)
+
+    @classmethod
+    def deliver(cls, session, review, parents):
+        """把 review 投递给被引用、被回复的评论的作者（不包括自己），返回收件人 ID 列表"""
+        recipients = sorted({p.user_id for p in parents if p is not None and p.user_id} - {review.user_id})
+        for user_id in recipients:
+            session.add(cls(recipient_id=user_id, review_id=review.id, create_time=review.create_time))
+        return recipients
+
+
+def iter_pages(conn, id_column, *columns, batch_size=1000):
+    """
+    按主键分页读取 (id, *columns)：每页一条 WHERE id > 上一页最大 ID ORDER BY id LIMIT 的查询，结果全部取回，
+    调用方可以在两页之间用同一个连接写入。服务端游标（yield_per）没读完时，MySQL 不能在同一连接上执行其他语句。
+    """
+    last = None
+    while True:
+        q = select(id_column, *columns).order_by(id_column).limit(batch_size)
+        if last is not None:
+            q = q.where(id_column > last)
+        rows = conn.execute(q).all()
+        if rows:
+            yield rows
+        if len(rows) < batch_size:
+            return
+        last = rows[-1][0]
+
+
 def user_syncdb(engine):
     Base.metadata.create_all(engine)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+评论内容的全文检索
+
+- SQLite: FTS5 虚拟表 review_fts，rowid 即评论 ID。中日韩文字在写入前切成二元组（bigram），
+  与 MySQL ngram 解析器（ngram_token_size=2）的切分方式一致；查询时每一段文字作为一个短语。
+  每个文字另外作为单字（unigram）写在二元组之后，只查一个字时按单字匹配。
+- MySQL: reviews.content 上的 FULLTEXT 索引（WITH PARSER ngram），由 MySQL 自行维护。
+  索引里只有二元组，单个字的查询改用 LIKE，与其他关键字的 MATCH 同时作为过滤条件。
+"""
+
+import re
+
+from sqlalchemy import Column, Integer, MetaData, Table, Text
+
+from models import Review, iter_pages
+
+RE_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"  # 假名、汉字、谚文
+RE_TOKEN = re.compile(r"([%s]+)|((?:(?![%s])[^\W_])+)" % (RE_CJK, RE_CJK))
+
+_metadata = MetaData()
+review_fts = Table("review_fts", _metadata, Column("rowid", Integer, primary_key=True), Column("tokens", Text))
+
+
+def split_terms(text):
+    """把文本切成若干段：连续的中日韩文字为一段，其他文字按单词分段"""
+    return [m.group(0) for m in RE_TOKEN.finditer((text or "").lower())]
+
+
+def bigrams(term):
+    if not re.match("[%s]" % RE_CJK, term) or len(term) == 1:
+        return [term]
+    return [term[i:i + 2] for i in range(len(term) - 1)]
+
+
+def unigrams(term):
+    if not re.match("[%s]" % RE_CJK, term):
+        return []
+    return list(term)
+
+
+def tokenize(text):
+    """
+    写入 FTS 表的内容，词之间用空格分隔。单字放在全部二元组之后并去重：
+    一段文字最后一个字只出现在二元组的后半部分，单字查询靠它们匹配；短语查询只由二元组组成，不受影响。
+    """
+    terms = split_terms(text)
+    tokens = [t for term in terms for t in bigrams(term)]
+    chars = dict.fromkeys(c for term in terms for c in unigrams(term) if c not in tokens)
+    return " ".join(tokens + list(chars))
+
+
+def single_cjk(term):
+    return len(term) == 1 and re.match("[%s]" % RE_CJK, term) is not None
+
+
+def match_expr(dialect, query):
+    """把用户输入转换成 MATCH 表达式，没有可检索的内容时返回空字符串"""
+    terms = split_terms(query)
+    if dialect == "mysql":
+        # ngram_token_size=2 的索引里没有单字，前缀查询也找不到一段文字末尾的字，单个字由 like_terms 过滤
+        return " ".join('+"%s"' % term for term in terms if not single_cjk(term))
+
+    # 单个汉字 bigrams() 返回它本身，正好匹配写入的单字
+    return " ".join('"%s"' % " ".join(bigrams(term)) for term in terms)
+
+
+def like_terms(dialect, query):
+    """MATCH 之外还要用 LIKE 过滤的关键字：MySQL 上的单个中日韩文字"""
+    if dialect != "mysql":
+        return []
+    return [term for term in split_terms(query) if single_cjk(term)]
+
+
+def supported(dialect):
+    return dialect in ("sqlite", "mysql")
+
+
+def create_index(conn):
+    """创建全文索引并导入已有的评论"""
+    if conn.dialect.name == "mysql":
+        conn.exec_driver_sql(
+            "ALTER TABLE reviews ADD FULLTEXT INDEX ft_reviews_content (content) WITH PARSER ngram, ALGORITHM=INPLACE"
+        )
+        return
+    if conn.dialect.name != "sqlite":
+        return
+    conn.exec_driver_sql("CREATE VIRTUAL TABLE IF NOT EXISTS review_fts USING fts5(tokens)")
+    rebuild_index(conn)
+
+
+def rebuild_index(conn, batch_size=1000):
+    """重新生成 SQLite 的 review_fts，返回导入的评论数"""
+    conn.execute(review_fts.delete())
+    total = 0
+    for page in iter_pages(conn, Review.id, Review.content, batch_size=batch_size):
+        conn.execute(review_fts.insert(), [{"rowid": review_id, "tokens": tokenize(content)} for review_id, content in page])
+        total += len(page)
+    return total
+
+
+def index_review(session, review):
+    """新评论写入索引，和评论在同一个事务中；review 需要已经 flush 拿到 ID"""
+    if session.get_bind().dialect.name == "sqlite":
+        session.execute(review_fts.insert().values(rowid=review.id, tokens=tokenize(review.content)))
+
+
+def search_query(session, query):
+    """返回 (Review 查询, 排序用的 ID 列)；没有可检索的关键字时返回 (None, None)"""
+    dialect = session.get_bind().dialect.name
+    expr, chars = match_expr(dialect, query), like_terms(dialect, query)
+    if not expr and not chars:
+        return None, None
+    if dialect == "mysql":
+        q = session.query(Review)
+        if expr:
+            q = q.filter(Review.content.match(expr))
+        for char in chars:
+            q = q.filter(Review.content.like("%" + char + "%"))
+        return q, Review.id
+
+    q = session.query(Review).join(review_fts, review_fts.c.rowid == Review.id)
+    return q.filter(review_fts.c.tokens.match(expr)), review_fts.c.rowid
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import datetime
+import logging
+import threading
+import time
+import traceback
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import Reader, Review, ReviewBook, ReviewChapter
+from services.async_service import SingletonType
+
+
+class StatCounters(metaclass=SingletonType):
+    """
+    首页统计用的各表行数，保存在内存中。
+
+    本进程内提交的新增行实时计入；后台线程定期重新 COUNT 一次，
+    纠正其他进程写入和删除带来的偏差。
+    """
+
+    MODELS = {Reader: "reader", ReviewBook: "book", ReviewChapter: "chapter", Review: "review"}
+
+    def __init__(self):
+        self.counts = {}
+        self.refresh_time = None
+        self.scoped_session = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def loaded(self):
+        return self.refresh_time is not None
+
+    def refresh(self, session):
+        counts = {name: session.query(model).count() for model, name in self.MODELS.items()}
+        with self._lock:
+            self.counts = counts
+            self.refresh_time = datetime.datetime.now()
+        return counts
+
+    def incr(self, delta):
+        with self._lock:
+            if not self.loaded():
+                return
+            for name, n in delta.items():
+                self.counts[name] = self.counts.get(name, 0) + n
+
+    def start(self, scoped_session, interval):
+        # 在 make_app 中调用，多进程模式下每个子进程各自启动
+        self.scoped_session = scoped_session
+        if self._thread is not None or interval <= 0:
+            return
+        self._thread = threading.Thread(target=self.loop, args=(interval,), daemon=True)
+        self._thread.name = self.__class__.__name__ + ".refresh"
+        self._thread.start()
+
+    def loop(self, interval):
+        while True:
+            try:
+                self.refresh(self.scoped_session())
+            except Exception as err:
+                logging.error("refresh stat counters error: %s", err)
+                logging.error(traceback.format_exc())
+            finally:
+                self.scoped_session.remove()
+            time.sleep(interval)
+
+    def data(self):
+        with self._lock:
+            d = dict(self.counts)
+        d["refresh_time"] = self.refresh_time.strftime("%Y-%m-%d %H:%M:%S") if self.refresh_time else ""
+        return d
+
+
+@event.listens_for(Session, "after_flush")
+def on_flush(session, flush_context):
+    delta = session.info.setdefault("stat_delta", {})
+    for obj in session.new:
+        name = StatCounters.MODELS.get(type(obj))
+        if name:
+            delta[name] = delta.get(name, 0) + 1
+    for obj in session.deleted:
+        name = StatCounters.MODELS.get(type(obj))
+        if name:
+            delta[name] = delta.get(name, 0) - 1
+
+
+@event.listens_for(Session, "after_commit")
+def on_commit(session):
+    delta = session.info.pop("stat_delta", None)
+    if delta:
+        StatCounters().incr(delta)
+
+
+@event.listens_for(Session, "after_rollback")
+def on_rollback(session):
+    session.info.pop("stat_delta", None)
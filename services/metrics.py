@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+Prometheus 文本格式的运行指标，由 /metrics 输出。
+
+请求计数和耗时直方图按线程分片记录：每个线程只写自己的 dict，记录时不加锁；
+输出时再把各分片合并。连接池、队列长度等瞬时值在输出时通过回调读取。
+
+多进程模式下每个子进程各有一份数据，所有指标都带上 worker 标签（子进程编号），
+各进程的计数各成一条序列。各进程定时把快照写入共享目录，输出时先写入本进程的快照，
+再从目录读取全部进程（包括本进程）的快照：抓取落在哪个进程都能拿到全部进程的指标，
+每条序列都只来自该进程写入的文件，文件只会越来越新，连续的抓取落在不同进程也不会看到计数回退。
+其他进程的数据最多落后一个写入间隔。
+"""
+
+import bisect
+import json
+import os
+import threading
+
+from services.async_service import SingletonType
+
+PREFIX = "review_"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 与 Prometheus 客户端的默认分桶一致，单位：秒
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, escape(v)) for k, v in labels) + "}"
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value) if value != int(value) else str(int(value))
+    return str(value)
+
+
+class Registry:
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._gauges = {}  # name -> (help, callback)
+        self._lock = threading.Lock()
+        self.worker = None
+        self.directory = None
+
+    def setup(self, worker, directory=None):
+        """多进程模式：worker 为子进程编号；directory 为各进程共享的快照目录，为空时只输出本进程的指标"""
+        self.worker = worker
+        self.directory = directory
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = {"requests": {}, "latency": {}}
+            self._local.shard = shard
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def observe_request(self, handler, method, status, seconds):
+        """记录一次请求；只在本线程的分片上累加"""
+        shard = self._shard()
+        key = (handler, method, str(status))
+        requests = shard["requests"]
+        requests[key] = requests.get(key, 0) + 1
+
+        key = (handler, method)
+        h = shard["latency"].get(key)
+        if h is None:
+            # 各分桶的计数（非累积），最后两项为总耗时和总次数
+            h = shard["latency"][key] = [0] * (len(BUCKETS) + 1) + [0.0, 0]
+        h[bisect.bisect_left(BUCKETS, seconds)] += 1
+        h[-2] += seconds
+        h[-1] += 1
+
+    def register_gauge(self, name, help, callback):
+        """callback 返回 [(labels, value)]，labels 为 ((name, value), ...)；同名的后注册的覆盖先注册的"""
+        with self._lock:
+            self._gauges[name] = (help, callback)
+
+    def unregister_gauge(self, name):
+        with self._lock:
+            self._gauges.pop(name, None)
+
+    def collect(self):
+        """合并各线程的分片，返回 (请求计数, 直方图)"""
+        with self._lock:
+            shards = list(self._shards)
+        requests, latency = {}, {}
+        for shard in shards:
+            # dict 的整体复制在持有 GIL 时完成，不会遇到写线程正在修改的中间状态
+            for key, n in list(shard["requests"].items()):
+                requests[key] = requests.get(key, 0) + n
+            for key, h in list(shard["latency"].items()):
+                total = latency.setdefault(key, [0] * len(h))
+                for i, v in enumerate(list(h)):
+                    total[i] += v
+        return requests, latency
+
+    def reset(self):
+        with self._lock:
+            for shard in self._shards:
+                shard["requests"].clear()
+                shard["latency"].clear()
+
+    def snapshot(self):
+        """本进程的全部指标，可以 JSON 序列化：labels 为 [[name, value], ...]"""
+        requests, latency = self.collect()
+        with self._lock:
+            gauges = sorted(self._gauges.items())
+        return {
+            "worker": self.worker,
+            "requests": [list(key) + [n] for key, n in sorted(requests.items())],
+            "latency": [list(key) + [h] for key, h in sorted(latency.items())],
+            "gauges": [[name, help, [[list(map(list, labels)), value] for labels, value in callback()]]
+                       for name, (help, callback) in gauges],
+        }
+
+    def snapshot_path(self, worker):
+        return os.path.join(self.directory, "%s.json" % worker)
+
+    def dump(self):
+        """把本进程的快照写入共享目录；先写临时文件再改名，其他进程不会读到写了一半的文件"""
+        path = self.snapshot_path(self.worker)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + ".tmp", path)
+
+    def snapshots(self):
+        """单进程时为本进程的实时数据；多进程时先写入本进程的快照，再读取共享目录中全部进程的快照"""
+        if not self.directory:
+            return [self.snapshot()]
+        self.dump()
+        result = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    result.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return sorted(result, key=lambda snap: -1 if snap["worker"] is None else snap["worker"])
+
+    def render(self):
+        lines = []
+        snapshots = self.snapshots()
+
+        def labels_of(snap, *labels):
+            if snap["worker"] is None:
+                return labels
+            return (("worker", snap["worker"]),) + labels
+
+        name = PREFIX + "http_requests_total"
+        lines.append("# HELP %s Total HTTP requests by handler, method and status." % name)
+        lines.append("# TYPE %s counter" % name)
+        for snap in snapshots:
+            for handler, method, status, n in snap["requests"]:
+                labels = labels_of(snap, ("handler", handler), ("method", method), ("status", status))
+                lines.append("%s%s %d" % (name, format_labels(labels), n))
+
+        name = PREFIX + "http_request_duration_seconds"
+        lines.append("# HELP %s HTTP request latency by handler and method." % name)
+        lines.append("# TYPE %s histogram" % name)
+        for snap in snapshots:
+            for handler, method, h in snap["latency"]:
+                labels = labels_of(snap, ("handler", handler), ("method", method))
+                cumulative = 0
+                for bound, n in zip(BUCKETS + ("+Inf",), h):
+                    cumulative += n
+                    le = labels + (("le", format_value(bound) if bound != "+Inf" else bound),)
+                    lines.append("%s_bucket%s %d" % (name, format_labels(le), cumulative))
+                lines.append("%s_sum%s %s" % (name, format_labels(labels), repr(h[-2])))
+                lines.append("%s_count%s %d" % (name, format_labels(labels), h[-1]))
+
+        # 同名的 gauge 只输出一次 HELP、TYPE，各进程的值依次列在下面
+        gauges = {}
+        for snap in snapshots:
+            for name, help, values in snap["gauges"]:
+                gauges.setdefault(name, (help, []))[1].extend(
+                    (labels_of(snap, *map(tuple, labels)), value) for labels, value in values
+                )
+        for name, (help, values) in sorted(gauges.items()):
+            lines.append("# HELP %s%s %s" % (PREFIX, name, help))
+            lines.append("# TYPE %s%s gauge" % (PREFIX, name))
+            for labels, value in values:
+                lines.append("%s%s%s %s" % (PREFIX, name, format_labels(labels), format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+class Metrics(Registry, metaclass=SingletonType):
+    """进程内共用的指标"""
+
+
+def prepare_directory(directory):
+    """多进程模式启动前由父进程调用：建立快照目录，删掉上次运行留下的快照"""
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith(".json") or name.endswith(".json.tmp"):
+            os.remove(os.path.join(directory, name))
+
+
+def pool_gauges(engines):
+    """
+    engines: {名称: Engine}。注册连接池的大小、已借出连接数、溢出连接数。
+    SingletonThreadPool 等没有这些统计的连接池会被跳过。
+    """
+
+    def read(method):
+        def callback():
+            values = []
+            for label, engine in engines.items():
+                fn = getattr(engine.pool, method, None)
+                if fn is not None:
+                    values.append(((("engine", label),), fn()))
+            return values
+
+        return callback
+
+    m = Metrics()
+    m.register_gauge("db_pool_size", "Configured size of the DB connection pool.", read("size"))
+    m.register_gauge("db_pool_checked_out", "DB connections currently checked out.", read("checkedout"))
+    m.register_gauge("db_pool_overflow", "DB connections opened beyond pool_size.", read("overflow"))
+
+
+def service_gauges():
+    """后台服务队列长度、密码校验线程池的排队数、长连接的订阅数"""
+    from services import AsyncService
+    from services.password import PasswordService
+    from services.pubsub import PubSub
+
+    def queue_depth():
+        with AsyncService._lock:
+            running = list(AsyncService.running.items())
+        return [((("service", name),), q.qsize()) for name, (t, q) in sorted(running)]
+
+    m = Metrics()
+    m.register_gauge("async_service_queue_depth", "Tasks waiting in AsyncService queues.", queue_depth)
+    m.register_gauge(
+        "password_pending",
+        "Password hash jobs waiting in or running on the thread pool.",
+        lambda: [((), PasswordService().stats()["pending"])],
+    )
+    m.register_gauge(
+        "pubsub_subscribers",
+        "Long-lived connections waiting for pushed events.",
+        lambda: [((), PubSub().stats()["subscribers"])],
+    )
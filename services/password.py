@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import asyncio
+import hashlib
+import hmac
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+
+import loader
+from services.async_service import SingletonType
+from utils import LRUCache
+
+CONF = loader.get_settings()
+
+
+class PasswordService(metaclass=SingletonType):
+    """
+    bcrypt 的计算放到独立的线程池里执行（bcrypt 计算时会释放GIL），不阻塞 IOLoop。
+
+    校验成功的结果会缓存一小段时间，缓存键是 (email, HMAC(库中的密码哈希 + 明文密码))，
+    不保存明文；密码一旦修改，库中的哈希变化，旧的缓存自然失效。
+    """
+
+    def __init__(self):
+        self.workers = int(CONF.get("password_workers", 2))
+        self.pending = 0  # 已提交、尚未完成的 bcrypt 计算数
+        self.cache = LRUCache(int(CONF.get("password_cache_size", 10000)), ttl=int(CONF.get("password_cache_ttl", 300)))
+        self._executor = None
+        self._secret = secrets.token_bytes(32)
+
+    @property
+    def executor(self):
+        # 延迟创建：多进程模式下线程池要在 fork 之后创建
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def run(self, func, *args):
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.pending -= 1
+
+    def cache_key(self, email, hashed, raw_password):
+        msg = (hashed + "\0" + raw_password).encode("UTF-8")
+        return (email, hmac.new(self._secret, msg, hashlib.sha256).digest())
+
+    async def check(self, user, raw_password):
+        """校验用户密码，返回 True/False"""
+        from models import Reader
+
+        hashed = user.password or ""
+        if not hashed:
+            return False
+        key = self.cache_key(user.email, hashed, raw_password)
+        if self.cache.get(key):
+            return True
+        ok = await self.run(Reader.check_password_hash, hashed, raw_password)
+        if ok:
+            self.cache.set(key, True)
+        return ok
+
+    async def set_password(self, user, raw_password):
+        """计算新密码的哈希并写入 user.password"""
+        from models import Reader
+
+        user.password = await self.run(Reader.make_password_hash, raw_password)
+
+    def stats(self):
+        return {"workers": self.workers, "pending": self.pending, "cache": self.cache.stats()}
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+进程内的发布订阅，把新回复等事件推给等待中的长连接（SSE、长轮询）。
+
+发布和订阅都在 IOLoop 线程上进行：每个订阅只是一个有界队列加一个 Event，
+等待中的连接不占线程，也不占数据库连接。消息不跨进程：多进程模式下只能通知到同一进程内的连接，
+未读数在客户端重连时会重新查一次，不会一直停留在旧值上；章节评论流由 handlers.feed.FeedPoller
+定时检查其他进程的变化。
+"""
+
+import collections
+import datetime
+
+from tornado import locks
+from tornado.util import TimeoutError
+
+from services.async_service import SingletonType
+
+
+class Subscription:
+    """一个连接的订阅；积压超过 maxsize 条时丢掉最旧的，处理慢的连接不会让内存无限增长"""
+
+    def __init__(self, hub, key, maxsize):
+        self.hub = hub
+        self.key = key
+        self.messages = collections.deque(maxlen=maxsize)
+        self.dropped = 0
+        self.closed = False
+        self._event = locks.Event()
+
+    def put(self, message):
+        if len(self.messages) == self.messages.maxlen:
+            self.dropped += 1
+            self.hub.dropped += 1
+        self.messages.append(message)
+        self._event.set()
+
+    async def get(self, timeout=None):
+        """等待并取出目前积压的全部消息；超时或订阅已关闭时返回 []"""
+        if not self.messages and not self.closed:
+            try:
+                await self._event.wait(None if timeout is None else datetime.timedelta(seconds=timeout))
+            except TimeoutError:
+                pass
+        self._event.clear()
+        messages = list(self.messages)
+        self.messages.clear()
+        return messages
+
+    def close(self):
+        """取消订阅，并唤醒正在 get() 的协程"""
+        if not self.closed:
+            self.closed = True
+            self.hub.unsubscribe(self)
+            self._event.set()
+
+
+class PubSub(metaclass=SingletonType):
+    def __init__(self):
+        self._subscribers = {}  # key -> set(Subscription)
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, key, maxsize=100):
+        sub = Subscription(self, key, maxsize)
+        self._subscribers.setdefault(key, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        subs = self._subscribers.get(sub.key)
+        if subs is None:
+            return
+        subs.discard(sub)
+        if not subs:
+            del self._subscribers[sub.key]
+
+    def has_subscribers(self, key):
+        return key in self._subscribers
+
+    def keys(self, kind):
+        """有订阅的 key 中，第一项为 kind 的那些"""
+        return [key for key in self._subscribers if key[0] == kind]
+
+    def publish(self, key, message):
+        """把消息放入 key 的所有订阅，返回订阅数"""
+        subs = list(self._subscribers.get(key, ()))
+        for sub in subs:
+            sub.put(message)
+        self.published += 1
+        return len(subs)
+
+    def stats(self):
+        return {
+            "keys": len(self._subscribers),
+            "subscribers": sum(len(s) for s in self._subscribers.values()),
+            "published": self.published,
+            "dropped": self.dropped,
+        }
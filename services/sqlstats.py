@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+"""
+按请求统计 SQL 语句数和数据库耗时，以及慢查询日志。
+
+BaseHandler.prepare 调用 start_request() 把一个 QueryStats 放进 ContextVar，
+引擎事件在执行每条语句后累加到当前请求上，最后由 _request_summary 写进访问日志。
+超过 slow_query_ms 的语句写到 slow_query 日志：只记录 SQL 文本和参数个数，不记录参数值，
+并附带一个指纹（去掉字面量、合并 IN 列表后的 SQL 的哈希），方便按语句归类。
+"""
+
+import contextvars
+import hashlib
+import logging
+import re
+import time
+
+from sqlalchemy import event
+
+import loader
+
+CONF = loader.get_settings()
+
+slow_log = logging.getLogger("slow_query")
+
+_current = contextvars.ContextVar("sql_stats", default=None)
+
+RE_STRING = re.compile(r"'(?:[^']|'')*'")
+RE_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+RE_PARAM = re.compile(r"%\(\w+\)s|%s|:\w+|\?|\$\d+")
+RE_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+RE_SPACE = re.compile(r"\s+")
+
+
+class QueryStats:
+    __slots__ = ("count", "seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __str__(self):
+        return "sql=%d/%.1fms" % (self.count, self.seconds * 1000)
+
+
+def start_request():
+    """在请求开始时调用，之后当前上下文中执行的 SQL 都计入返回的 QueryStats"""
+    stats = QueryStats()
+    _current.set(stats)
+    return stats
+
+
+def current():
+    return _current.get()
+
+
+def normalize(statement):
+    """把 SQL 中的参数和字面量替换成 ?，IN (?, ?, ...) 合并为 IN (...)"""
+    s = RE_STRING.sub("?", statement)
+    s = RE_PARAM.sub("?", s)
+    s = RE_NUMBER.sub("?", s)
+    s = RE_IN_LIST.sub("(...)", s)
+    return RE_SPACE.sub(" ", s).strip()
+
+
+def fingerprint(statement):
+    return hashlib.sha1(normalize(statement).encode("UTF-8")).hexdigest()[:12]
+
+
+def count_params(parameters, executemany):
+    if executemany:
+        return "%d rows" % len(parameters)
+    return "%d params" % len(parameters or ())
+
+
+def instrument(engine):
+    """给同步引擎（异步引擎请传 async_engine.sync_engine）挂上计时事件"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        stats = _current.get()
+        if stats is not None:
+            stats.count += 1
+            stats.seconds += elapsed
+
+        threshold = CONF.get("slow_query_ms", 0)
+        if threshold and elapsed * 1000 >= threshold:
+            slow_log.warning(
+                "%.1fms fp=%s [%s] %s",
+                elapsed * 1000,
+                fingerprint(statement),
+                count_params(parameters, executemany),
+                RE_SPACE.sub(" ", statement).strip(),
+            )
+
+    @event.listens_for(engine, "handle_error")
+    def on_error(context):
+        starts = context.connection.info.get("query_start") if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+
+def setup_slow_log(path):
+    """慢查询单独写到文件；不设置时跟随根日志输出"""
+    if not path or slow_log.handlers:
+        return
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    slow_log.addHandler(handler)
+    slow_log.propagate = False
@@ -19,6 +19,62 @@ settings = {
         "echo": False,
     },
 
+    # 异步数据库模式（需要安装 aiosqlite / asyncmy），以及同步驱动到异步驱动的对应关系
+    "db_async": False,
+    "db_async_drivers": {
+        "sqlite": "sqlite+aiosqlite",
+        "mysql": "mysql+asyncmy",
+        "mysql+pymysql": "mysql+asyncmy",
+    },
+
+    # 进程内缓存的章节数（段落评论数），0 表示关闭
+    "summary_cache_size": 10000,
+
+    # bcrypt 线程池大小；校验成功的 Basic 认证缓存（秒、条数）
+    "password_workers": 2,
+    "password_cache_ttl": 300,
+    "password_cache_size": 10000,
+
+    # 当前用户信息的进程内缓存（秒、条数）
+    "reader_cache_ttl": 60,
+    "reader_cache_size": 10000,
+
+    # 接口返回 JSON 时使用的编码库：auto（依次尝试 orjson、ujson、标准库）、orjson、ujson、json
+    "json_encoder": "auto",
+
+    # 响应压缩：按优先顺序列出可用的编码（br、zstd 需要安装 brotli、zstandard），为空则不压缩；
+    # 小于 compress_min_size 字节的响应不压缩；compress_levels 为各编码的压缩级别
+    "compress_encodings": ["zstd", "br", "gzip"],
+    "compress_min_size": 1024,
+    "compress_levels": {"gzip": 6, "br": 4, "zstd": 3},
+
+    # 慢查询日志：超过该耗时（毫秒）的 SQL 写入 slow_query 日志，0 为关闭；日志文件为空时跟随主日志
+    "slow_query_ms": 200,
+    "slow_query_log": "",
+
+    # 多进程模式下各进程共享的指标快照目录，每隔 metrics_dump_interval 秒写入一次，/metrics 合并输出；
+    # 为空时使用临时目录下的 review-metrics-<端口>
+    "metrics_dir": "",
+    "metrics_dump_interval": 5,
+
+    # 「与我相关」未读数的长连接：SSE 保活注释的间隔、长轮询最长等待时间（秒）
+    "notify_heartbeat": 25,
+    "notify_poll_timeout": 30,
+
+    # 章节实时评论流（WebSocket）：每个连接最多积压的消息数，超过后丢弃并通知客户端重新同步；
+    # websocket_ping_interval 由 tornado 使用，定时 ping 以发现断开的连接
+    "feed_queue_size": 64,
+    "websocket_ping_interval": 30,
+    # 多进程模式下检查其他进程新评论的间隔（秒），0 为不检查
+    "feed_poll_interval": 2,
+
+    # 首页统计数据后台重新计数的间隔（秒）
+    "stat_refresh_interval": 300,
+
+    # 评论列表分页：默认每页条数、最大每页条数
+    "review_page_size": 50,
+    "review_page_max": 200,
+
     # 100MB, tornado default max_buffer_size value
     "MAX_UPLOAD_SIZE": "100MB",
 
@@ -1,16 +1,26 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
+import asyncio
 import base64
+import datetime
 import json
+import multiprocessing
 import os
+import re
 import sys
 import shutil
+import tempfile
+import threading
 import time
 import unittest
 import urllib
 from unittest import mock
-from tornado import testing, web
+
+import sqlalchemy
+import sqlalchemy.orm
+from tornado import httputil, testing, web, websocket
+from tornado.tcpclient import TCPClient
 
 testdir = os.path.dirname(os.path.realpath(__file__))
 projdir = os.path.realpath(testdir + "/../")
@@ -18,8 +28,12 @@ print(projdir)
 sys.path.append(projdir)
 
 import handlers
-import main, models  # nosq: E402
+import dbtool, main, migrations, models, search, utils  # nosq: E402
 from handlers.base import BaseHandler
+from services import metrics
+from services.counters import StatCounters
+from services.password import PasswordService
+from services.pubsub import PubSub
 
 _app = None
 _mock_user = None
@@ -59,6 +73,7 @@ def setup_server():
     # main.CONF["db_engine_args"] = {"echo": True}
     if _app is None:
         _app = main.make_app()
+        migrations.migrate(_app._engine)
 
 
 def setup_mock_user():
@@ -95,6 +110,7 @@ class FakeHandler(BaseHandler):
         h.rsp = None
         h.cookie = {}
         h.session = get_db()
+        h.async_session = None
 
     def write(self, rsp):
         self.rsp = rsp
@@ -140,6 +156,31 @@ class TestAppWithoutLogin(TestApp):
         self.assertTrue(d["data"]['id'] >= 0)
 
 
+class TestReviewBookAlias(TestApp):
+    def get_book(self, title):
+        d = self.json("/api/review/book?title=" + Q(title))
+        self.assertEqual(d["err"], "ok")
+        return d["data"]["id"]
+
+    def test_alias(self):
+        session = get_db()
+        book = models.ReviewBook(title="三体", alias="三体|Three Body\n三体　全集")
+        session.add(book)
+        session.commit()
+        book_id = book.id
+        session.remove()
+        with _app._engine.begin() as conn:
+            self.assertGreaterEqual(migrations.rebuild_book_aliases(conn, batch_size=2), 3)
+
+        self.assertEqual(self.get_book("三体"), book_id)
+        self.assertEqual(self.get_book("three  BODY"), book_id)
+        self.assertEqual(self.get_book("三体 全集"), book_id)
+
+        new_id = self.get_book("  Alias   Unittest ")
+        self.assertNotEqual(new_id, book_id)
+        self.assertEqual(self.get_book("alias unittest"), new_id)
+
+
 class AutoResetPermission:
     def __init__(self, arg):
         if not arg:
@@ -216,6 +257,94 @@ class TestUser(TestWithUserLogin):
         d = self.json("/api/user/sign_in", method="POST", body=f"email={email}&password={password}")
         self.assertEqual(d["err"], "ok")
 
+    def test_concurrent_login(self):
+        # 校验密码时会让出 IOLoop，并发的登录请求不能互相关闭对方的 session
+        password = 'concurrent'
+        emails = ["concurrent-%d@email.com" % i for i in range(10)]
+        db = get_db()
+        db.query(models.Reader).filter(models.Reader.email.in_(emails)).delete()
+        hashed = models.Reader.make_password_hash(password)
+        now = datetime.datetime.now()
+        for email in emails:
+            db.add(models.Reader(email=email, nickname=email, password=hashed, permission="",
+                                 create_time=now, update_time=now, access_time=now))
+        db.commit()
+
+        async def sign_in(email):
+            body = f"email={email}&password={password}"
+            rsp = await self.http_client.fetch(self.get_url("/api/user/sign_in"), method="POST", body=body,
+                                               raise_error=False)
+            return json.loads(rsp.body)["err"]
+
+        async def run():
+            return await asyncio.gather(*[sign_in(email) for email in emails])
+
+        try:
+            self.assertEqual(self.io_loop.run_sync(run, timeout=60), ["ok"] * len(emails))
+        finally:
+            db.query(models.Reader).filter(models.Reader.email.in_(emails)).delete()
+            db.commit()
+
+    def test_session_per_request(self):
+        # SignIn、UserUpdate 等在校验密码时会让出 IOLoop，同一线程上交错执行的请求必须各用各的 session，
+        # 不能是线程级的 ScopedSession()，否则先结束的请求会把其他请求的 session 关掉
+        conn = mock.Mock()
+        handlers_ = [BaseHandler(_app, httputil.HTTPServerRequest(method="GET", uri="/", connection=conn))
+                     for _ in range(2)]
+        self.assertIsNot(handlers_[0].session, handlers_[1].session)
+        self.assertIsNot(handlers_[0].session, get_db()())
+        for h in handlers_:
+            h.session.close()
+
+    def test_update_password(self):
+        user = get_db().get(models.Reader, 1)
+        user.set_secure_password("unittest")
+        get_db().commit()
+
+        body = {"password0": "wrong", "password1": "unittest2"}
+        d = self.json("/api/user/update", method="POST", body=json.dumps(body))
+        self.assertEqual(d["err"], "params.password.error")
+
+        body = {"password0": "unittest", "password1": "unittest2"}
+        d = self.json("/api/user/update", method="POST", body=json.dumps(body))
+        self.assertEqual(d["err"], "ok")
+        get_db().expire_all()
+        self.assertTrue(get_db().get(models.Reader, 1).get_secure_password("unittest2"))
+
+
+class TestReaderCache(TestWithUserLogin):
+    def info(self):
+        with CountStatements(_app._engine) as c:
+            d = self.json("/api/user/info")
+        self.assertEqual(d["err"], "ok")
+        return d["data"], c.count
+
+    def test_cache(self):
+        handlers.base.READER_CACHE.clear()
+        data, n = self.info()
+        self.assertEqual(n, 1)
+        data, n = self.info()
+        self.assertEqual(n, 0)
+
+        # 权限修改后缓存失效
+        user = get_db().get(models.Reader, 1)
+        user.set_permission("U")
+        get_db().commit()
+        data, n = self.info()
+        self.assertEqual((data["permission"], n), ("U", 1))
+
+        # 修改昵称的接口拿到的是当前 session 中的对象，修改后缓存同样失效
+        nickname = data["nickname"]
+        d = self.json("/api/user/update", method="POST", body=json.dumps({"nickname": "cached-name"}))
+        self.assertEqual(d["data"]["nickname"], "cached-name")
+        data, n = self.info()
+        self.assertEqual(data["nickname"], "cached-name")
+
+        d = self.json("/api/user/update", method="POST", body=json.dumps({"nickname": nickname}))
+        user = get_db().get(models.Reader, 1)
+        user.permission = ""
+        get_db().commit()
+
 
 class TestUserSignUp(TestWithUserLogin):
     @classmethod
@@ -268,28 +397,996 @@ class TestUserSignUp(TestWithUserLogin):
         # build fake auth header unittest:unittest
         f = FakeHandler()
         f.request.headers["Authorization"] = "xxxxx"
-        self.assertEqual(False, BaseHandler.process_auth_header(f))
+        self.assertEqual(False, self.process_auth_header(f))
 
         f.request.headers["Authorization"] = self.auth("username:password")
-        self.assertEqual(False, BaseHandler.process_auth_header(f))
+        self.assertEqual(False, self.process_auth_header(f))
 
         f.request.headers["Authorization"] = self.auth("unittest:password")
-        self.assertEqual(False, BaseHandler.process_auth_header(f))
+        self.assertEqual(False, self.process_auth_header(f))
 
         ts = int(time.time())
         f.request.headers["Authorization"] = self.auth(
             "unittest@email.com:unittest"
         )
-        self.assertEqual(True, BaseHandler.process_auth_header(f))
+        self.assertEqual(True, self.process_auth_header(f))
         self.assertTrue(int(f.cookie["lt"]) >= ts)
         self.assertTrue(int(f.cookie["lt"]) >= ts)
 
+        # 校验成功的结果被缓存，再次登录不再计算 bcrypt
+        with mock.patch("bcrypt.checkpw") as checkpw:
+            self.assertEqual(True, self.process_auth_header(f))
+            f.request.headers["Authorization"] = self.auth("unittest@email.com:wrong")
+            checkpw.return_value = False
+            self.assertEqual(False, self.process_auth_header(f))
+            self.assertEqual(checkpw.call_count, 1)
+        self.assertEqual(PasswordService().pending, 0)
+
         self.delete_user()
 
+    def process_auth_header(self, f):
+        return self.io_loop.run_sync(lambda: BaseHandler.process_auth_header(f))
+
     def auth(self, s):
         return "Basic " + base64.encodebytes(s.encode("ascii")).decode("ascii")
 
 
+class TestReviewSummaryCache(TestWithUserLogin):
+    BOOK_ID = 101
+    CHAPTER = "第一章 缓存"
+
+    def add_review(self, segment_id):
+        body = {"book_id": self.BOOK_ID, "chapter_name": self.CHAPTER, "segment_id": segment_id, "content": "unittest"}
+        return self.json("/api/review/add", method="POST", body=json.dumps(body))
+
+    def summary(self):
+        d = self.json("/api/review/summary?book_id=%d&chapter_name=%s" % (self.BOOK_ID, Q(self.CHAPTER)))
+        self.assertEqual(d["err"], "ok")
+        return {row["segmentId"]: row["reviewNum"] for row in d["data"]["list"]}
+
+    def test_summary_cache(self):
+        self.assertEqual(self.add_review(1)["err"], "ok")
+        stats = handlers.review.SUMMARY_CACHE.stats()
+        self.assertEqual(self.summary(), {1: 1})
+        self.assertEqual(handlers.review.SUMMARY_CACHE.misses, stats["misses"] + 1)
+
+        # 没有变化时命中缓存
+        self.assertEqual(self.summary(), {1: 1})
+        self.assertEqual(handlers.review.SUMMARY_CACHE.hits, stats["hits"] + 1)
+
+        # 写入后数量立即可见
+        self.assertEqual(self.add_review(1)["err"], "ok")
+        self.assertEqual(self.add_review(2)["err"], "ok")
+        self.assertEqual(self.summary(), {1: 2, 2: 1})
+
+        # 其他进程写入的评论只改了库里的计数，本进程的缓存也不会返回旧值
+        db = get_db()
+        row = db.query(models.SegmentReviewCount).filter_by(book_id=self.BOOK_ID, segment_id=2).one()
+        models.SegmentReviewCount.incr(db, self.BOOK_ID, row.chapter_id, 2)
+        db.commit()
+        self.assertEqual(self.summary(), {1: 2, 2: 2})
+
+    def test_lru_eviction(self):
+        cache = utils.LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.stats(), {"size": 2, "maxsize": 2, "ttl": 0, "hits": 1, "misses": 1, "evictions": 1})
+
+
+class CountStatements:
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def on_execute(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        sqlalchemy.event.listen(self.engine, "before_cursor_execute", self.on_execute)
+        return self
+
+    def __exit__(self, type, value, trace):
+        sqlalchemy.event.remove(self.engine, "before_cursor_execute", self.on_execute)
+
+
+def add_reviews(book_id, chapter_id, segment_id, n):
+    """直接写库生成评论：两个用户交替发言，每条引用上一条"""
+    session = get_db()
+    now = datetime.datetime.now()
+    level = session.query(models.Review).filter(
+        models.Review.book_id == book_id, models.Review.chapter_id == chapter_id, models.Review.segment_id == segment_id
+    ).count()
+    quote = None
+    for i in range(n):
+        row = models.Review(
+            book_id=book_id, chapter_id=chapter_id, segment_id=segment_id, content="review %d" % i, level=level + i + 1,
+            user_id=1 + i % 2, create_time=now, update_time=now, quote_id=quote.id if quote else None,
+        )
+        session.add(row)
+        session.flush()
+        models.ReviewInbox.deliver(session, row, [quote])
+        session.commit()
+        quote = row
+        if row.user_id == 1:
+            quote.update_time = now + datetime.timedelta(seconds=1)
+            session.commit()
+    session.remove()
+
+
+class TestReviewListQueries(TestWithUserLogin):
+    BOOK_ID = 102
+    CHAPTER_ID = 1020
+    SEGMENT_ID = 1
+
+    def count_statements(self, url):
+        with CountStatements(_app._engine) as c:
+            d = self.json(url)
+        self.assertEqual(d["err"], "ok")
+        return c.count, len(d["data"]["list"])
+
+    def test_list_statements(self):
+        url = "/api/review/list?book_id=%d&chapter_id=%d&segment_id=%d" % (self.BOOK_ID, self.CHAPTER_ID, self.SEGMENT_ID)
+        add_reviews(self.BOOK_ID, self.CHAPTER_ID, self.SEGMENT_ID, 2)
+        small, rows = self.count_statements(url)
+        self.assertEqual(rows, 2)
+        add_reviews(self.BOOK_ID, self.CHAPTER_ID, self.SEGMENT_ID, 30)
+        large, rows = self.count_statements(url)
+        self.assertEqual(rows, 32)
+        self.assertLessEqual(large, 3)
+        self.assertEqual(small, large)
+
+        small, rows = self.count_statements("/api/review/me")
+        self.assertLessEqual(small, 3)
+
+
+class TestReviewPagination(TestWithUserLogin):
+    BOOK_ID = 103
+    CHAPTER_ID = 1030
+    SEGMENT_ID = 1
+
+    def fetch_all(self, url, limit):
+        ids, cursor, pages = [], "", 0
+        while True:
+            d = self.json(url + "&limit=%d&cursor=%s" % (limit, cursor))
+            self.assertEqual(d["err"], "ok")
+            self.assertLessEqual(len(d["data"]["list"]), limit)
+            ids += [row["reviewId"] for row in d["data"]["list"]]
+            pages += 1
+            cursor = d["data"]["next_cursor"]
+            if not cursor:
+                return ids, pages
+
+    def test_list(self):
+        add_reviews(self.BOOK_ID, self.CHAPTER_ID, self.SEGMENT_ID, 11)
+        url = "/api/review/list?book_id=%d&chapter_id=%d&segment_id=%d" % (self.BOOK_ID, self.CHAPTER_ID, self.SEGMENT_ID)
+        ids, pages = self.fetch_all(url, 4)
+        self.assertEqual(pages, 3)
+        self.assertEqual(len(ids), 11)
+        levels = [r.level for r in get_db().query(models.Review).filter(models.Review.id.in_(ids))]
+        self.assertEqual(sorted(levels), list(range(1, 12)))
+        self.assertEqual(ids, sorted(ids))
+
+        d = self.json(url + "&cursor=xxx")
+        self.assertEqual(d["err"], "params.invalid")
+        d = self.json(url + "&limit=abc")
+        self.assertEqual(d["err"], "params.invalid")
+
+    def test_me(self):
+        add_reviews(self.BOOK_ID, self.CHAPTER_ID, self.SEGMENT_ID + 1, 6)
+        total = self.json("/api/review/me?count=1")["data"]["count"]
+        ids, pages = self.fetch_all("/api/review/me?", 2)
+        self.assertEqual(len(ids), total)
+        self.assertEqual(len(set(ids)), total)
+
+
+class TestReviewBookSummary(TestWithUserLogin):
+    BOOK_ID = 104
+
+    def add_review(self, chapter_name, segment_id):
+        body = {"book_id": self.BOOK_ID, "chapter_name": chapter_name, "segment_id": segment_id, "content": "unittest"}
+        d = self.json("/api/review/add", method="POST", body=json.dumps(body))
+        self.assertEqual(d["err"], "ok")
+        return d["data"]["chapterId"]
+
+    def test_book_summary(self):
+        c1 = self.add_review("第一章", 1)
+        self.add_review("第一章", 1)
+        self.add_review("第一章", 3)
+        c2 = self.add_review("第二章", 2)
+
+        d = self.json("/api/review/book_summary?book_id=%d" % self.BOOK_ID)
+        self.assertEqual(d["err"], "ok")
+        self.assertEqual(d["data"]["chapters"], [[c1, "第一章", "第一章", 3], [c2, "第二章", "第二章", 1]])
+        self.assertEqual(d["data"]["segments"], {})
+
+        d = self.json("/api/review/book_summary?book_id=%d&chapter_ids=%d" % (self.BOOK_ID, c1))
+        self.assertEqual(d["data"]["chapters"][0][3], 3)
+        self.assertEqual(d["data"]["chapters"][1][3], 1)
+        self.assertEqual(d["data"]["segments"], {str(c1): [[1, 2], [3, 1]]})
+
+        d = self.json("/api/review/book_summary?book_id=%d&chapter_ids=a" % self.BOOK_ID)
+        self.assertEqual(d["err"], "params.invalid")
+
+
+def insert_reviews_worker(db_path, n):
+    engine = sqlalchemy.create_engine("sqlite:///" + db_path, connect_args={"timeout": 60})
+    Session = sqlalchemy.orm.sessionmaker(bind=engine)
+    for i in range(n):
+        session = Session()
+        level = models.SegmentReviewCount.incr(session, 105, 1050, 1)
+        session.add(models.Review(book_id=105, chapter_id=1050, segment_id=1, level=level, content="race %d" % i))
+        session.commit()
+        session.close()
+    engine.dispose()
+
+
+class TestConcurrentLevel(TestApp):
+    WORKERS = 4
+    REVIEWS = 25
+
+    def test_no_duplicate_levels(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, "concurrent.db")
+        shutil.copyfile(testdir + "/.unittest.db", path)
+        try:
+            ctx = multiprocessing.get_context("fork")
+            procs = [ctx.Process(target=insert_reviews_worker, args=(path, self.REVIEWS)) for _ in range(self.WORKERS)]
+            for p in procs:
+                p.start()
+            for p in procs:
+                p.join(60)
+                self.assertEqual(p.exitcode, 0)
+
+            engine = sqlalchemy.create_engine("sqlite:///" + path)
+            with engine.connect() as conn:
+                q = sqlalchemy.select(models.Review.level).where(models.Review.book_id == 105)
+                levels = sorted(conn.execute(q).scalars())
+            engine.dispose()
+            self.assertEqual(levels, list(range(1, self.WORKERS * self.REVIEWS + 1)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestAsyncMode(TestWithUserLogin):
+    BOOK_ID = 106
+    CHAPTER = "第一章 异步"
+    _async_app = None
+
+    def get_app(self):
+        cls = TestAsyncMode
+        if cls._async_app is None:
+            main.CONF["db_async"] = True
+            try:
+                cls._async_app = main.make_app()
+            finally:
+                main.CONF["db_async"] = False
+        return cls._async_app
+
+    def test_async_session(self):
+        self.assertIsNotNone(self._app.settings.get("AsyncSession"))
+
+        body = {"book_id": self.BOOK_ID, "chapter_name": self.CHAPTER, "segment_id": 1, "content": "async"}
+        d = self.json("/api/review/add", method="POST", body=json.dumps(body))
+        self.assertEqual(d["err"], "ok")
+        self.assertEqual(d["data"]["level"], 1)
+        chapter_id = d["data"]["chapterId"]
+
+        d = self.json("/api/review/summary?book_id=%d&chapter_name=%s" % (self.BOOK_ID, Q(self.CHAPTER)))
+        self.assertEqual(d["data"]["list"], [{"segmentId": 1, "reviewNum": 1}])
+
+        d = self.json("/api/review/list?book_id=%d&chapter_id=%d&segment_id=1" % (self.BOOK_ID, chapter_id))
+        self.assertEqual([row["content"] for row in d["data"]["list"]], ["async"])
+
+        d = self.json("/api/user/info")
+        self.assertEqual(d["data"]["id"], 1)
+
+        rsp = self.fetch("/")
+        self.assertEqual(rsp.code, 200)
+        self.assertIn(b"Reviews:", rsp.body)
+
+
+class TestSystemStat(TestWithUserLogin):
+    def db_count(self, model):
+        n = get_db().query(model).count()
+        get_db().remove()
+        return n
+
+    def test_stat(self):
+        # 其他用例里有批量删除，不经过 ORM 计数，先重新统计一次
+        StatCounters().refresh(get_db())
+        get_db().remove()
+        d = self.json("/api/stat")
+        self.assertEqual(d["err"], "ok")
+        self.assertEqual(d["data"]["count"]["review"], self.db_count(models.Review))
+        self.assertEqual(d["data"]["count"]["reader"], self.db_count(models.Reader))
+
+        # 写入后无需重新统计即可看到
+        body = {"book_id": 107, "chapter_name": "统计", "segment_id": 1, "content": "stat"}
+        self.assertEqual(self.json("/api/review/add", method="POST", body=json.dumps(body))["err"], "ok")
+        with CountStatements(_app._engine) as c:
+            d = self.json("/api/stat")
+        self.assertEqual(c.count, 0)
+        self.assertEqual(d["data"]["count"]["review"], self.db_count(models.Review))
+        self.assertEqual(d["data"]["count"]["chapter"], self.db_count(models.ReviewChapter))
+
+        rsp = self.fetch("/")
+        self.assertIn(("Reviews: %d" % self.db_count(models.Review)).encode(), rsp.body)
+
+
+class TestReviewSearch(TestWithUserLogin):
+    BOOK_ID = 108
+
+    def add_review(self, chapter_name, content):
+        body = {"book_id": self.BOOK_ID, "chapter_name": chapter_name, "segment_id": 1, "content": content}
+        d = self.json("/api/review/add", method="POST", body=json.dumps(body))
+        self.assertEqual(d["err"], "ok")
+        return d["data"]
+
+    def search(self, q, **kwargs):
+        args = "".join("&%s=%s" % (k, v) for k, v in kwargs.items())
+        d = self.json("/api/review/search?q=%s&book_id=%d%s" % (Q(q), self.BOOK_ID, args))
+        self.assertEqual(d["err"], "ok")
+        return d["data"]
+
+    def test_tokenize(self):
+        self.assertEqual(search.tokenize("三体人来了! Hello"), "三体 体人 人来 来了 hello 三 体 人 来 了")
+        self.assertEqual(search.tokenize("林 森林"), "林 森林 森")
+        self.assertEqual(search.match_expr("sqlite", "林"), '"林"')
+
+        # MySQL 的 ngram 索引没有单字：单个字不进 MATCH，改用 LIKE
+        self.assertEqual(search.match_expr("mysql", "字"), "")
+        self.assertEqual(search.match_expr("mysql", "林 森林"), '+"森林"')
+        self.assertEqual(search.like_terms("mysql", "林 森林"), ["林"])
+        self.assertEqual(search.like_terms("sqlite", "林"), [])
+        engine = sqlalchemy.create_mock_engine("mysql+pymysql://", lambda *args, **kwargs: None)
+        q, _ = search.search_query(sqlalchemy.orm.Session(bind=engine), "字")
+        sql = str(q.statement.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
+        self.assertIn("reviews.content LIKE '%%字%%'", sql)
+        self.assertNotIn("MATCH", sql)
+        self.assertEqual(search.match_expr("sqlite", "体人 hello"), '"体人" "hello"')
+        self.assertEqual(search.match_expr("mysql", "体人 hello"), '+"体人" +"hello"')
+
+    def test_search(self):
+        r1 = self.add_review("第一章", "黑暗森林法则真是可怕")
+        r2 = self.add_review("第一章", "Dark Forest 的设定很有意思")
+        r3 = self.add_review("第二章", "又见黑暗森林")
+        self.add_review("第二章", "森林里的小动物")
+
+        d = self.search("黑暗森林")
+        self.assertEqual([r["reviewId"] for r in d["list"]], [r3["reviewId"], r1["reviewId"]])
+        d = self.search("黑暗森林", chapter_id=r1["chapterId"])
+        self.assertEqual([r["reviewId"] for r in d["list"]], [r1["reviewId"]])
+        d = self.search("dark")
+        self.assertEqual([r["reviewId"] for r in d["list"]], [r2["reviewId"]])
+        self.assertEqual(self.search("暗森 可怕")["list"][0]["reviewId"], r1["reviewId"])
+        self.assertEqual(self.search("猫咪")["list"], [])
+        # 单个字，包括只出现在一段文字末尾的字
+        d = self.search("林")
+        self.assertEqual(len(d["list"]), 3)
+        self.assertIn(r3["reviewId"], [r["reviewId"] for r in d["list"]])
+        self.assertEqual([r["reviewId"] for r in self.search("设")["list"]], [r2["reviewId"]])
+
+        # 分页
+        d = self.search("森林", limit=2)
+        self.assertEqual(len(d["list"]), 2)
+        d = self.search("森林", limit=2, cursor=d["next_cursor"])
+        self.assertEqual(len(d["list"]), 1)
+        self.assertEqual(d["next_cursor"], "")
+
+
+def parse_metrics(text):
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            values[name] = float(value)
+    return values
+
+
+class TestMetrics(TestApp):
+    def metrics(self):
+        rsp = self.fetch("/metrics")
+        self.assertEqual(rsp.code, 200)
+        self.assertTrue(rsp.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+        return parse_metrics(rsp.body.decode("UTF-8"))
+
+    def test_metrics(self):
+        self.fetch("/api/review/book?title=unittest")
+        before = self.metrics()
+        self.fetch("/api/review/book?title=unittest")
+        self.fetch("/api/review/list?book_id=abc")
+        values = self.metrics()
+
+        name = 'review_http_requests_total{handler="ReviewGetBook",method="GET",status="200"}'
+        self.assertEqual(values[name], before[name] + 1)
+        name = 'review_http_requests_total{handler="ReviewList",method="GET",status="400"}'
+        self.assertEqual(values[name], before.get(name, 0) + 1)
+
+        name = 'review_http_request_duration_seconds_%s{handler="ReviewGetBook",method="GET"%s}'
+        count = values[name % ("count", "")]
+        self.assertEqual(values[name % ("bucket", ',le="+Inf"')], count)
+        self.assertLessEqual(values[name % ("bucket", ',le="0.005"')], values[name % ("bucket", ',le="10"')])
+        self.assertGreater(values[name % ("sum", "")], 0)
+
+        self.assertIn('review_db_pool_checked_out{engine="sync"}', values)
+        self.assertIn("review_password_pending", values)
+
+    def test_workers(self):
+        self.fetch("/api/review/book?title=unittest")
+        m = metrics.Metrics()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(m.setup, None)
+        metrics.prepare_directory(directory)
+        # 模拟另一个子进程写入的快照，本进程的数据在输出时实时读取
+        m.setup(1, directory)
+        m.dump()
+        m.setup(0, directory)
+        self.fetch("/api/review/book?title=unittest")
+        values = self.metrics()
+
+        name = 'review_http_requests_total{worker="%d",handler="ReviewGetBook",method="GET",status="200"}'
+        self.assertEqual(values[name % 0], values[name % 1] + 1)
+        self.assertIn('review_db_pool_checked_out{worker="0",engine="sync"}', values)
+        self.assertIn('review_db_pool_checked_out{worker="1",engine="sync"}', values)
+        self.assertIn('review_password_pending{worker="1"}', values)
+        self.assertFalse([k for k in values if "worker" not in k])
+
+    def test_monotonic(self):
+        # 两个子进程共用快照目录，连续的抓取交替落在两个进程上，每条计数序列都不能回退
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        workers = [metrics.Registry(), metrics.Registry()]
+        for i, m in enumerate(workers):
+            m.setup(i, directory)
+            m.dump()  # 定时写入的快照，之后的请求都比它新
+        last = {}
+        for i in range(3):
+            for m in workers:
+                m.observe_request("T", "GET", 200, 0.01)
+                values = parse_metrics(m.render())
+                for name, value in last.items():
+                    self.assertGreaterEqual(values.get(name, 0), value, name)
+                last = {k: v for k, v in values.items() if "_total" in k or "_count" in k or "_bucket" in k}
+        name = 'review_http_requests_total{worker="%d",handler="T",method="GET",status="200"}'
+        self.assertEqual((last[name % 0], last[name % 1]), (3, 3))
+
+    def test_threads(self):
+        # 独立的实例，不在进程共用的 Metrics() 上留下分片
+        m = metrics.Registry()
+        threads = [threading.Thread(target=lambda: [m.observe_request("T", "GET", 200, 0.2) for i in range(1000)])
+                   for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        requests, latency = m.collect()
+        self.assertEqual(requests[("T", "GET", "200")], 4000)
+        self.assertEqual(latency[("T", "GET")][metrics.BUCKETS.index(0.25)], 4000)
+
+
+class TestQueryStats(TestApp):
+    def test_access_log(self):
+        with self.assertLogs("tornado.access", level="INFO") as logs:
+            self.fetch("/api/review/book?title=unittest")
+        self.assertRegex(logs.output[-1], r"/api/review/book\?title=unittest .* sql=[1-9]\d*/\d+\.\dms")
+
+    def test_slow_query_log(self):
+        old = main.CONF["slow_query_ms"]
+        main.CONF["slow_query_ms"] = 0.000001
+        try:
+            with self.assertLogs("slow_query", level="WARNING") as logs:
+                self.fetch("/api/review/book?title=secret-title-1")
+                self.fetch("/api/review/book?title=secret-title-2")
+        finally:
+            main.CONF["slow_query_ms"] = old
+        lines = [line for line in logs.output if "review_books.title =" in line]
+        self.assertGreaterEqual(len(lines), 2)
+        self.assertNotIn("secret-title", "\n".join(logs.output))
+        fps = {re.search(r"fp=(\w+)", line).group(1) for line in lines}
+        self.assertEqual(len(fps), 1)
+
+    def test_fingerprint(self):
+        from services import sqlstats
+
+        a = "SELECT * FROM reviews WHERE id IN (?, ?, ?) AND level > 3 AND content = 'x'"
+        b = "SELECT *  FROM reviews\nWHERE id IN (?) AND level > 10 AND content = 'it''s'"
+        self.assertEqual(sqlstats.normalize(a), "SELECT * FROM reviews WHERE id IN (...) AND level > ? AND content = ?")
+        self.assertEqual(sqlstats.fingerprint(a), sqlstats.fingerprint(b))
+
+
+class TestJsonEncoder(TestApp):
+    def test_encoders(self):
+        obj = {"err": "ok", "data": {"list": [{"content": "中文</script>", "level": 1}], 3: [1.5, None, True]}}
+        expect = json.loads(json.dumps(obj))
+        for name in ("json", "orjson", "ujson"):
+            try:
+                lib, encode = utils.json_encoder(name)
+            except ValueError:
+                continue
+            self.assertEqual(lib, name)
+            data = encode(obj)
+            self.assertIsInstance(data, bytes)
+            self.assertEqual(json.loads(data), expect)
+        self.assertIn(utils.json_encoder("auto")[0], ("orjson", "ujson", "json"))
+        self.assertRaises(ValueError, utils.json_encoder, "nosuchlib")
+
+    def test_response(self):
+        title = "json</script>测试"
+        rsp = self.fetch("/api/review/book?title=" + Q(title))
+        self.assertEqual(rsp.headers["Content-Type"], "application/json; charset=UTF-8")
+        self.assertNotIn(b"</", rsp.body)
+        self.assertEqual(json.loads(rsp.body)["data"]["title"], title)
+
+
+class TestReviewETag(TestWithUserLogin):
+    BOOK_ID = 109
+
+    def add_review(self, segment_id, **kwargs):
+        body = dict(book_id=self.BOOK_ID, chapter_name="缓存", segment_id=segment_id, content="etag", **kwargs)
+        d = self.json("/api/review/add", method="POST", body=json.dumps(body))
+        self.assertEqual(d["err"], "ok")
+        return d["data"]
+
+    def fetch_etag(self, url, etag=None):
+        headers = {"If-None-Match": etag} if etag else {}
+        with CountStatements(_app._engine) as c:
+            rsp = self.fetch(url, headers=headers)
+        return rsp, c.count
+
+    def test_list(self):
+        r1 = self.add_review(1)
+        url = "/api/review/list?book_id=%d&chapter_id=%d&segment_id=1" % (self.BOOK_ID, r1["chapterId"])
+        rsp, _ = self.fetch_etag(url)
+        self.assertEqual(rsp.code, 200)
+        etag = rsp.headers["Etag"]
+
+        rsp, count = self.fetch_etag(url, etag)
+        self.assertEqual(rsp.code, 304)
+        self.assertEqual(rsp.body, b"")
+        self.assertEqual(count, 1)  # 只查了段落版本
+
+        # 分页参数不同，ETag 也不同
+        rsp, _ = self.fetch_etag(url + "&limit=1", etag)
+        self.assertEqual(rsp.code, 200)
+
+        # 新评论
+        self.add_review(1)
+        rsp, _ = self.fetch_etag(url, etag)
+        self.assertEqual(rsp.code, 200)
+        self.assertEqual(len(json.loads(rsp.body)["data"]["list"]), 2)
+        etag = rsp.headers["Etag"]
+
+        # 其他段落的评论回复了本段落的评论：被回复的评论 update_time 变了
+        self.add_review(2, quote_id=r1["reviewId"], root_id=r1["reviewId"])
+        rsp, _ = self.fetch_etag(url, etag)
+        self.assertEqual(rsp.code, 200)
+
+    def test_summary(self):
+        self.add_review(1)
+        url = "/api/review/summary?book_id=%d&chapter_name=%s" % (self.BOOK_ID, Q("缓存"))
+        rsp, _ = self.fetch_etag(url)
+        etag = rsp.headers["Etag"]
+        rsp, count = self.fetch_etag(url, etag)
+        self.assertEqual(rsp.code, 304)
+        self.assertEqual(count, 1)  # 只查了章节，版本号随章节一起读出
+
+        self.add_review(3)
+        rsp, _ = self.fetch_etag(url, etag)
+        self.assertEqual(rsp.code, 200)
+        self.assertNotEqual(rsp.headers["Etag"], etag)
+
+        # 其他进程写入的评论：本进程的缓存没有更新，ETag 仍然随库中的版本号变化
+        etag = rsp.headers["Etag"]
+        db = get_db()
+        models.SegmentReviewCount.incr(db, self.BOOK_ID, json.loads(rsp.body)["data"]["chapter_id"], 3)
+        db.commit()
+        rsp, _ = self.fetch_etag(url, etag)
+        self.assertEqual(rsp.code, 200)
+        self.assertIn({"segmentId": 3, "reviewNum": 2}, json.loads(rsp.body)["data"]["list"])
+
+
+class TestCompression(TestWithUserLogin):
+    BOOK_ID, CHAPTER_ID, SEGMENT_ID = 110, 1100, 1
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        add_reviews(cls.BOOK_ID, cls.CHAPTER_ID, cls.SEGMENT_ID, 10)
+
+    def fetch_list(self, accept_encoding, etag=None):
+        url = "/api/review/list?book_id=%d&chapter_id=%d&segment_id=%d" % (self.BOOK_ID, self.CHAPTER_ID, self.SEGMENT_ID)
+        headers = {"Accept-Encoding": accept_encoding}
+        if etag:
+            headers["If-None-Match"] = etag
+        return self.fetch(url, headers=headers, decompress_response=False)
+
+    def test_encodings(self):
+        import gzip
+        from handlers import compress
+
+        plain = self.fetch_list("identity")
+        self.assertNotIn("Content-Encoding", plain.headers)
+        self.assertEqual(plain.headers["Vary"], "Accept-Encoding")
+        self.assertGreater(len(plain.body), 1024)
+
+        decoders = {"gzip": gzip.decompress}
+        if "br" in compress.CODECS:
+            import brotli
+            decoders["br"] = brotli.decompress
+        if "zstd" in compress.CODECS:
+            import zstandard
+            decoders["zstd"] = zstandard.ZstdDecompressor().decompressobj().decompress
+        for name, decode in decoders.items():
+            rsp = self.fetch_list(name)
+            self.assertEqual(rsp.headers["Content-Encoding"], name)
+            self.assertLess(len(rsp.body), len(plain.body))
+            self.assertEqual(int(rsp.headers["Content-Length"]), len(rsp.body))
+            self.assertEqual(json.loads(decode(rsp.body)), json.loads(plain.body))
+            self.assertEqual(rsp.headers["Etag"], compress.encoding_etag(plain.headers["Etag"], name))
+            self.assertNotEqual(rsp.headers["Etag"], plain.headers["Etag"])
+
+    def test_etag(self):
+        from handlers import compress
+
+        plain = self.fetch_list("identity").headers["Etag"]
+        gzipped = self.fetch_list("gzip").headers["Etag"]
+        self.assertEqual(gzipped, compress.encoding_etag(plain, "gzip"))
+        self.assertFalse(gzipped.startswith("W/"))
+
+        # 304 的 ETag 与客户端缓存的表示一致
+        rsp = self.fetch_list("gzip", etag=gzipped)
+        self.assertEqual((rsp.code, rsp.headers["Etag"]), (304, gzipped))
+        self.assertNotIn("Content-Encoding", rsp.headers)
+        rsp = self.fetch_list("gzip", etag=plain)
+        self.assertEqual((rsp.code, rsp.headers["Etag"]), (304, plain))
+        rsp = self.fetch_list("identity", etag=plain)
+        self.assertEqual((rsp.code, rsp.headers["Etag"]), (304, plain))
+        # 缓存的是压缩的表示，本次不接受压缩：返回未压缩的内容
+        rsp = self.fetch_list("identity", etag=gzipped)
+        self.assertEqual((rsp.code, rsp.headers["Etag"]), (200, plain))
+
+    def test_negotiation(self):
+        from handlers import compress
+
+        preferred = ["zstd", "br", "gzip"]
+        available = [name for name in preferred if name in compress.CODECS]
+        self.assertEqual(compress.choose_encoding("gzip, deflate", preferred), "gzip")
+        self.assertEqual(compress.choose_encoding("gzip;q=0.5, br;q=1, zstd;q=1", preferred), available[0])
+        self.assertEqual(compress.choose_encoding("gzip;q=0, *;q=0", preferred), None)
+        self.assertEqual(compress.choose_encoding("", preferred), None)
+        self.assertEqual(compress.choose_encoding("*", ["gzip"]), "gzip")
+        self.assertNotIn("Content-Encoding", self.fetch_list("gzip;q=0").headers)
+
+    def test_min_size(self):
+        rsp = self.fetch("/api/review/book?title=unittest", headers={"Accept-Encoding": "gzip"}, decompress_response=False)
+        self.assertLess(len(rsp.body), 1024)
+        self.assertNotIn("Content-Encoding", rsp.headers)
+
+
+class TestReviewInbox(TestWithUserLogin):
+    BOOK_ID = 111
+
+    def add_review(self, user_id, **kwargs):
+        self.user.return_value = user_id
+        body = dict(book_id=self.BOOK_ID, chapter_name="收件箱", segment_id=1, content="inbox", **kwargs)
+        d = self.json("/api/review/add", method="POST", body=json.dumps(body))
+        self.user.return_value = 1
+        self.assertEqual(d["err"], "ok")
+        return d["data"]["reviewId"]
+
+    def unread(self):
+        return self.json("/api/review/me?count=1")["data"]["count"]
+
+    def mark_read(self, last_id=""):
+        d = self.json("/api/review/me/read", method="POST", body="last_id=%s" % last_id)
+        self.assertEqual(d["err"], "ok")
+        return d["data"]["last_read_id"]
+
+    def test_inbox(self):
+        self.mark_read()
+        self.assertEqual(self.unread(), 0)
+
+        mine = self.add_review(1)
+        r1 = self.add_review(2, quote_id=mine, root_id=mine)  # 引用和回复是同一条，只投递一次
+        self.add_review(1, quote_id=r1, root_id=mine)  # 自己回复自己的帖子，不投递
+        r2 = self.add_review(2, quote_id=mine)
+        self.assertEqual(self.unread(), 2)
+
+        d = self.json("/api/review/me?limit=1")
+        self.assertEqual([row["reviewId"] for row in d["data"]["list"]], [r2])
+        self.assertEqual(d["data"]["list"][0]["quoteReviewId"], mine)
+        d = self.json("/api/review/me?limit=1&cursor=" + d["data"]["next_cursor"])
+        self.assertEqual([row["reviewId"] for row in d["data"]["list"]], [r1])
+        self.assertEqual(d["data"]["next_cursor"], "")
+
+        # 已读到 r1 为止；已读位置不会后退
+        first = d["data"]["list"][0]["inboxId"]
+        self.assertEqual(self.mark_read(first), first)
+        self.assertEqual(self.unread(), 1)
+        self.assertEqual(self.mark_read(first - 1), first)
+        self.assertGreater(self.mark_read(), first)
+        self.assertEqual(self.unread(), 0)
+
+        # 标记已读的请求落在其他进程时，本进程缓存的用户快照仍是旧的已读位置，未读数以数据库为准
+        values = get_db().get(models.Reader, 1).to_dict()
+        get_db().remove()
+        handlers.base.READER_CACHE.set(1, dict(values, last_read_id=0))
+        self.assertEqual(self.unread(), 0)
+        self.assertEqual(self.json("/api/review/me")["data"]["list"], [])
+        self.assertEqual(self.json("/api/review/me/read", method="POST", body="last_id=x")["err"], "params.invalid")
+
+
+async def wait_until(check):
+    for _ in range(200):
+        if check():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("timeout")
+
+
+class TestReviewNotify(TestWithUserLogin):
+    BOOK_ID = 112
+
+    async def fetch_json(self, url, user_id=1, **kwargs):
+        self.user.return_value = user_id
+        rsp = await self.http_client.fetch(self.get_url(url), raise_error=False, **kwargs)
+        self.user.return_value = 1
+        return json.loads(rsp.body)
+
+    async def add_review(self, user_id, **kwargs):
+        body = dict(book_id=self.BOOK_ID, chapter_name="推送", segment_id=1, content="notify", **kwargs)
+        d = await self.fetch_json("/api/review/add", user_id, method="POST", body=json.dumps(body))
+        self.assertEqual(d["err"], "ok")
+        return d["data"]["reviewId"]
+
+    @testing.gen_test
+    async def test_long_poll(self):
+        await self.fetch_json("/api/review/me/read", method="POST", body="")
+        mine = await self.add_review(1)
+
+        wait = asyncio.ensure_future(self.fetch_json("/api/review/me/wait?count=0"))
+        await wait_until(lambda: PubSub().has_subscribers(("unread", 1)))
+        self.assertFalse(wait.done())
+        await self.add_review(2, quote_id=mine)
+        self.assertEqual((await wait)["data"]["count"], 1)
+        self.assertFalse(PubSub().has_subscribers(("unread", 1)))
+
+        # 已知的数量与当前不同，立即返回
+        d = await self.fetch_json("/api/review/me/wait?count=5")
+        self.assertEqual(d["data"]["count"], 1)
+        d = await self.fetch_json("/api/review/me/wait?count=x")
+        self.assertEqual(d["err"], "params.invalid")
+
+    @testing.gen_test
+    async def test_events(self):
+        await self.fetch_json("/api/review/me/read", method="POST", body="")
+        mine = await self.add_review(1)
+
+        stream = await TCPClient().connect("127.0.0.1", self.get_http_port())
+        await stream.write(b"GET /api/review/me/events HTTP/1.1\r\nHost: localhost\r\nAccept-Encoding: gzip\r\n\r\n")
+        head = await stream.read_until(b"\r\n\r\n")
+        self.assertIn(b"text/event-stream", head)
+        self.assertNotIn(b"Content-Encoding", head)
+
+        async def next_event():
+            await stream.read_until(b"event: unread\ndata: ")
+            return json.loads(await stream.read_until(b"\n\n"))
+
+        self.assertEqual(await next_event(), {"count": 0})
+        await self.add_review(2, quote_id=mine)
+        self.assertEqual(await next_event(), {"count": 1})
+        await self.fetch_json("/api/review/me/read", method="POST", body="")
+        self.assertEqual(await next_event(), {"count": 0})
+
+        # 断开后订阅随之取消
+        stream.close()
+        await wait_until(lambda: not PubSub().has_subscribers(("unread", 1)))
+
+
+class TestReviewFeed(TestWithUserLogin):
+    BOOK_ID = 113
+
+    async def add_review(self, segment_id):
+        body = dict(book_id=self.BOOK_ID, chapter_name="实时", segment_id=segment_id, content="feed")
+        rsp = await self.http_client.fetch(self.get_url("/api/review/add"), method="POST", body=json.dumps(body))
+        return json.loads(rsp.body)["data"]
+
+    async def connect(self, chapter_id):
+        ws = await websocket.websocket_connect(self.get_url("/api/review/feed").replace("http:", "ws:"))
+        ws.write_message(json.dumps({"action": "subscribe", "book_id": self.BOOK_ID, "chapter_id": chapter_id}))
+        self.assertEqual(json.loads(await ws.read_message()), {
+            "type": "subscribed", "bookId": self.BOOK_ID, "chapterId": chapter_id})
+        return ws
+
+    @testing.gen_test
+    async def test_feed(self):
+        chapter_id = (await self.add_review(1))["chapterId"]
+        ws = await self.connect(chapter_id)
+        other = await self.connect(chapter_id + 1)
+
+        r = await self.add_review(2)
+        d = json.loads(await ws.read_message())
+        self.assertEqual((d["type"], d["segmentId"], d["count"]), ("review", 2, 1))
+        self.assertEqual(d["review"]["reviewId"], r["reviewId"])
+        self.assertEqual(d["review"]["isSelf"], False)
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(other.read_message(), 0.1)
+
+        ws.write_message("{}")
+        self.assertEqual(json.loads(await ws.read_message())["err"], "params.invalid")
+        ws.close()
+        other.close()
+        await wait_until(lambda: not PubSub().has_subscribers(("chapter", self.BOOK_ID, chapter_id)))
+
+    @testing.gen_test
+    async def test_resync(self):
+        ws = await self.connect(1)
+        # 客户端还没来得及读，积压超过队列长度：丢弃并通知重新同步
+        for i in range(100):
+            PubSub().publish(("chapter", self.BOOK_ID, 1), b'{"type": "review"}')
+        self.assertEqual(json.loads(await ws.read_message())["type"], "resync")
+        PubSub().publish(("chapter", self.BOOK_ID, 1), b'{"type": "review"}')
+        self.assertEqual(json.loads(await ws.read_message())["type"], "review")
+        ws.close()
+
+    @testing.gen_test
+    async def test_poller(self):
+        chapter_id = (await self.add_review(1))["chapterId"]
+        ws = await self.connect(chapter_id)
+        poller = handlers.feed.FeedPoller(_app.settings["ScopedSession"])
+        handlers.feed.FeedPoller.instance = poller
+        self.addCleanup(setattr, handlers.feed.FeedPoller, "instance", None)
+        await poller.poll()
+
+        # 本进程推送过的新评论不需要重新同步
+        await self.add_review(2)
+        self.assertEqual(json.loads(await ws.read_message())["type"], "review")
+        await poller.poll()
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(ws.read_message(), 0.1)
+
+        # 本进程的评论已登记、还没提交完时检查，提交后再检查，都不算其他进程的评论
+        db = get_db()
+        handlers.feed.FeedPoller.expect(self.BOOK_ID, chapter_id)
+        await poller.poll()
+        models.SegmentReviewCount.incr(db, self.BOOK_ID, chapter_id, 3)
+        db.commit()
+        await poller.poll()
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(ws.read_message(), 0.1)
+
+        # 其他进程写入的评论
+        models.SegmentReviewCount.incr(db, self.BOOK_ID, chapter_id, 3)
+        db.commit()
+        get_db().remove()
+        await poller.poll()
+        self.assertEqual(json.loads(await ws.read_message()), {
+            "type": "resync", "bookId": self.BOOK_ID, "chapterId": chapter_id})
+        ws.close()
+
+    def test_origin_allowed(self):
+        allowed = ["*.talebook.org", "https://www.example.com"]
+        self.assertTrue(handlers.base.origin_allowed("https://talebook.org", allowed))
+        self.assertTrue(handlers.base.origin_allowed("https://www.talebook.org:8443", allowed))
+        self.assertTrue(handlers.base.origin_allowed("https://www.example.com", allowed))
+        self.assertFalse(handlers.base.origin_allowed("https://eviltalebook.org", allowed))
+        self.assertFalse(handlers.base.origin_allowed("https://talebook.org.evil.com", allowed))
+        self.assertFalse(handlers.base.origin_allowed("https://example.com", allowed))
+        self.assertFalse(handlers.base.origin_allowed("null", allowed))
+        self.assertTrue(handlers.base.origin_allowed("null", ["*"]))
+
+
+class TestDbTool(TestApp):
+    def test_roundtrip(self):
+        add_reviews(114, 1140, 1, 3)
+        with tempfile.TemporaryDirectory() as tmp:
+            exported = dbtool.export_db(_app._engine, tmp, batch_size=2)
+            self.assertGreaterEqual(exported["reviews"]["rows"], 3)
+            with open(os.path.join(tmp, "reviews.jsonl")) as f:
+                row = json.loads(f.readline())
+            self.assertRegex(row["create_time"], r"^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d")
+
+            engine = sqlalchemy.create_engine("sqlite:///%s/copy.db" % tmp)
+            imported = dbtool.import_db(engine, tmp, batch_size=2)
+            self.assertEqual({k: v["rows"] for k, v in imported.items()}, {k: v["rows"] for k, v in exported.items()})
+            counts = dbtool.rebuild(engine)
+            for table in dbtool.TABLES:
+                # 重建计数后 review_version 会加一，让缓存的段落评论数失效
+                q = sqlalchemy.select(*[c for c in table.c if c.name != "review_version"]).order_by(table.c.id)
+                with _app._engine.connect() as src, engine.connect() as dst:
+                    self.assertEqual(src.execute(q).fetchall(), dst.execute(q).fetchall(), table.name)
+            t = models.ReviewBookAlias.__table__
+            q = sqlalchemy.select(t.c.book_id, t.c.alias).order_by(t.c.book_id, t.c.alias)
+            with _app._engine.connect() as src, engine.connect() as dst:
+                self.assertEqual(counts["review_inbox"], migrations.rebuild_review_inbox(src))
+                self.assertEqual(counts["review_book_aliases"], migrations.rebuild_book_aliases(src))
+                self.assertEqual(src.execute(q).fetchall(), dst.execute(q).fetchall())
+                self.assertEqual(dbtool.books_without_alias(dst), 0)
+                src.rollback()
+            engine.dispose()
+
+        with self.assertRaises(ValueError):
+            dbtool.select_tables(["no_such_table"])
+
+    def test_import_missing_keys(self):
+        # 各行的字段不同：第一行缺少的字段不影响后面的行，缺少的字段取默认值
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "review_chapters.jsonl"), "w") as f:
+                f.write(json.dumps({"id": 1, "book_id": 1, "title": "第一章"}) + "\n")
+                f.write(json.dumps({"id": 2, "book_id": 1, "title": "第二章", "alias": "第二章（求月票）", "x": 1}) + "\n")
+            engine = sqlalchemy.create_engine("sqlite:///%s/copy.db" % tmp)
+            dbtool.import_db(engine, tmp, batch_size=1)
+            t = models.ReviewChapter.__table__
+            with engine.connect() as conn:
+                rows = conn.execute(sqlalchemy.select(t.c.id, t.c.alias, t.c.parents).order_by(t.c.id)).fetchall()
+            engine.dispose()
+        self.assertEqual([tuple(row) for row in rows], [(1, "", ""), (2, "第二章（求月票）", "")])
+
+
+class TestMigrations(TestApp):
+    def test_migrate(self):
+        engine = _app._engine
+        self.assertEqual(migrations.migrate(engine), [])
+
+        names = [i["name"] for i in sqlalchemy.inspect(engine).get_indexes("reviews")]
+        self.assertIn("ix_reviews_segment", names)
+        self.assertIn("ix_reviews_user_update", names)
+        self.assertIn("ix_reviews_root", names)
+
+    def test_rebuild_segment_counts(self):
+        R = models.Review
+        expect = get_db().query(
+            R.book_id, R.chapter_id, R.segment_id, sqlalchemy.func.count(), sqlalchemy.func.max(R.update_time)
+        ).group_by(R.book_id, R.chapter_id, R.segment_id)
+        expect = sorted(tuple(row) for row in expect)
+        get_db().remove()
+
+        with _app._engine.begin() as conn:
+            conn.execute(sqlalchemy.update(models.SegmentReviewCount).values(review_count=999))
+            self.assertEqual(migrations.rebuild_segment_counts(conn), len(expect))
+            rows = conn.execute(sqlalchemy.select(models.SegmentReviewCount.__table__)).fetchall()
+        self.assertEqual(sorted(tuple(row) for row in rows), expect)
+
+    def test_rebuild_book_aliases(self):
+        session = get_db()
+        session.add_all(models.ReviewBook(title="分页%d" % i, alias="Page %d|第%d本" % (i, i)) for i in range(7))
+        session.commit()
+        B = models.ReviewBook
+        expect = sorted(
+            (book_id, name)
+            for book_id, title, alias in session.query(B.id, B.title, B.alias)
+            for name in models.ReviewBookAlias.split((title or "") + "\n" + (alias or ""))
+        )
+        session.remove()
+
+        # 书的数量比 batch_size 多，每一页的别名都要写入
+        t = models.ReviewBookAlias.__table__
+        with _app._engine.begin() as conn:
+            self.assertEqual(migrations.rebuild_book_aliases(conn, batch_size=3), len(expect))
+            rows = sorted(conn.execute(sqlalchemy.select(t.c.book_id, t.c.alias)).fetchall())
+        self.assertEqual(rows, expect)
+
+    def test_rebuild_review_inbox(self):
+        add_reviews(111, 1110, 2, 4)
+        t = models.ReviewInbox.__table__
+        with _app._engine.begin() as conn:
+            expect = sorted(conn.execute(sqlalchemy.select(t.c.review_id, t.c.recipient_id)).fetchall())
+            self.assertEqual(migrations.rebuild_review_inbox(conn), len(expect))
+            rows = sorted(conn.execute(sqlalchemy.select(t.c.review_id, t.c.recipient_id)).fetchall())
+        self.assertEqual(rows, expect)
+        self.assertGreaterEqual(len(expect), 3)
+
+    def test_explain(self):
+        with _app._engine.connect() as conn:
+            for name, stmt in migrations.handler_queries():
+                plan = " ".join(str(row) for row in migrations.explain(conn, stmt))
+                self.assertNotIn("SCAN reviews", plan, name)
+
+
 class TestJsonResponse(TestApp):
     def raise_(self, err):
         raise err
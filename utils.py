@@ -1,8 +1,130 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
+import base64
+import collections
+import json
+import threading
+import time
+
 
 def super_strip(s):
     # 删除掉所有不可见的字符
     # issue: https://github.com/talebook/talebook/issues/304
     return ''.join(c for c in s.strip() if c.isprintable())
+
+
+class LRUCache:
+    """进程内的LRU缓存，记录命中/未命中/淘汰次数，方便评估容量；ttl>0 时条目会过期"""
+
+    def __init__(self, maxsize=1024, ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and self.ttl and item[1] < time.monotonic():
+                del self._data[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def peek(self, key, default=None):
+        # 不影响LRU顺序和统计，用于写入时的更新
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or (self.ttl and item[1] < time.monotonic()):
+                return default
+            return item[0]
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return item[0] if item else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def encode_cursor(*values):
+    # 分页游标：对客户端不透明，内容是最后一行的排序键
+    s = json.dumps(values, separators=(",", ":"))
+    return base64.urlsafe_b64encode(s.encode("UTF-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        s = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(s)
+    except Exception:
+        return None
+    return values if isinstance(values, list) else None
+
+
+def json_encoder(name="auto"):
+    """
+    返回 (实际使用的库名, 编码函数)，编码函数把对象直接编码为 UTF-8 的 bytes。
+    name 为 auto 时依次尝试 orjson、ujson，都没有安装则使用标准库 json。
+    """
+    names = ["orjson", "ujson", "json"] if name == "auto" else [name]
+    for lib in names:
+        if lib == "orjson":
+            try:
+                import orjson
+            except ImportError:
+                continue
+            option = orjson.OPT_NON_STR_KEYS  # 与标准库一样允许整数等作为键
+
+            def encode(obj):
+                return orjson.dumps(obj, option=option)
+
+            return lib, encode
+
+        if lib == "ujson":
+            try:
+                import ujson
+            except ImportError:
+                continue
+
+            def encode(obj):
+                return ujson.dumps(obj, ensure_ascii=False).encode("UTF-8")
+
+            return lib, encode
+
+        if lib == "json":
+            return lib, lambda obj: json.dumps(obj).encode("UTF-8")
+    raise ValueError("JSON encoder %s is not available" % name)